@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+import HueControlBot as bot_hue
+from HueBridgeSimulator import SimuladorHue
+
+# ─────────────────────────────────────────────────────────────
+# Benchmark de extremo a extremo del bot contra un bridge simulado
+# y una API de Telegram falsa, sin red ni cuenta real.
+#
+#   python HueBenchmark.py --chats 20 --taps 2 --duracion 30
+# ─────────────────────────────────────────────────────────────
+
+ACCIONES = ["toggle", "bright_inc", "bright_dec", "bright_set:50", "ct_inc", "ct_dec"]
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+# ─────────────────────────────────────────────────────────────
+# API de Telegram falsa
+# ─────────────────────────────────────────────────────────────
+
+class BotFalso:
+    # Registra cada llamada y resuelve la latencia tap→edición de cada chat
+
+    def __init__(self, latencia=0.03, intervalo_flood=None):
+        self.latencia = latencia
+        self.intervalo_flood = intervalo_flood
+        self.llamadas = {}
+        self.latencias = []
+        self._taps_pendientes = {}   # chat_id -> instantes de taps aún sin edición
+        self._ultima_edicion = {}
+        self._mensajes = 0
+
+    def registrar_tap(self, chat_id):
+        self._taps_pendientes.setdefault(chat_id, []).append(time.monotonic())
+
+    def _contar(self, metodo):
+        self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        self._contar("sendMessage")
+        await asyncio.sleep(self.latencia)
+        self._mensajes += 1
+        return SimpleNamespace(message_id=self._mensajes, chat_id=chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None, parse_mode=None):
+        self._contar("editMessageText")
+        ahora = time.monotonic()
+        if self.intervalo_flood and ahora - self._ultima_edicion.get(chat_id, 0) < self.intervalo_flood:
+            raise RetryAfter(1)
+        self._ultima_edicion[chat_id] = ahora
+        await asyncio.sleep(self.latencia)
+        fin = time.monotonic()
+        for inicio in self._taps_pendientes.pop(chat_id, []):
+            self.latencias.append(fin - inicio)
+
+    async def delete_message(self, chat_id, message_id):
+        self._contar("deleteMessage")
+        await asyncio.sleep(self.latencia)
+
+# ─────────────────────────────────────────────────────────────
+# Application, JobQueue y Update mínimos para invocar los handlers
+# ─────────────────────────────────────────────────────────────
+
+class JobFalso:
+
+    def __init__(self, data=None):
+        self.data = data
+        self.tarea = None
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+        if self.tarea:
+            self.tarea.cancel()
+
+class JobQueueFalsa:
+
+    def __init__(self, aplicacion):
+        self.aplicacion = aplicacion
+        self._jobs = []
+
+    def jobs(self):
+        return tuple(job for job in self._jobs if not job.removed and not (job.tarea and job.tarea.done()))
+
+    def _contexto(self, job):
+        return SimpleNamespace(bot=self.aplicacion.bot, job=job, job_queue=self,
+                               application=self.aplicacion, chat_data={})
+
+    def run_repeating(self, callback, interval, first=None, data=None, **kwargs):
+        job = JobFalso(data)
+
+        async def bucle():
+            await asyncio.sleep(interval if first is None else first)
+            while True:
+                await callback(self._contexto(job))
+                await asyncio.sleep(interval)
+
+        job.tarea = asyncio.create_task(bucle())
+        self._jobs.append(job)
+        return job
+
+    def run_once(self, callback, when, data=None, **kwargs):
+        job = JobFalso(data)
+
+        async def una_vez():
+            await asyncio.sleep(when if isinstance(when, (int, float)) else 0)
+            resultado = callback(self._contexto(job))
+            if asyncio.iscoroutine(resultado):
+                await resultado
+
+        job.tarea = asyncio.create_task(una_vez())
+        self._jobs.append(job)
+        return job
+
+class AplicacionFalsa:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.job_queue = JobQueueFalsa(self)
+        self.chat_data = {}
+        self._tareas = set()
+
+    def create_task(self, coro):
+        tarea = asyncio.create_task(coro)
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+        return tarea
+
+    def contexto(self, chat_id):
+        return SimpleNamespace(bot=self.bot, job_queue=self.job_queue, application=self,
+                               chat_data=self.chat_data.setdefault(chat_id, {}), args=[])
+
+async def nada(*args, **kwargs):
+    return None
+
+def update_comando(chat_id, texto="/hue"):
+    return SimpleNamespace(
+        effective_message=SimpleNamespace(delete=nada, text=texto),
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id),
+        message=SimpleNamespace(reply_text=nada)
+    )
+
+def update_callback(chat_id, message_id, data):
+    return SimpleNamespace(
+        callback_query=SimpleNamespace(
+            data=data,
+            answer=nada,
+            message=SimpleNamespace(chat_id=chat_id, message_id=message_id),
+            from_user=SimpleNamespace(id=chat_id)
+        ),
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id)
+    )
+
+# ─────────────────────────────────────────────────────────────
+# Carga
+# ─────────────────────────────────────────────────────────────
+
+def contar_renders():
+    # Envuelve los generadores de paneles para saber cuántos renders se hacen
+    contador = {"renders": 0}
+    for nombre in ("generar_panel_principal", "generar_panel_habitacion", "generar_panel_color"):
+        original = getattr(bot_hue, nombre)
+
+        async def envoltorio(*args, _original=original, **kwargs):
+            contador["renders"] += 1
+            return await _original(*args, **kwargs)
+
+        setattr(bot_hue, nombre, envoltorio)
+    return contador
+
+def contar_lecturas(simuladores):
+    return sum(n for sim in simuladores for clave, n in sim.contadores.items() if clave.startswith("GET"))
+
+async def simular_chat(app, chat_id, taps_por_segundo, fin):
+    contexto = app.contexto(chat_id)
+    await bot_hue.hue(update_comando(chat_id), contexto)
+    message_id = bot_hue.PANEL_MENSAJES[chat_id]
+    while time.monotonic() < fin:
+        habitacion = random.choice(list(bot_hue.HABITACIONES))
+        accion = random.choice(ACCIONES)
+        for data in (f"room:{habitacion}", f"{accion}:{habitacion}"):
+            app.bot.registrar_tap(chat_id)
+            await bot_hue.callback_handler(update_callback(chat_id, message_id, data), contexto)
+            await asyncio.sleep(random.expovariate(taps_por_segundo))
+
+async def ejecutar(args):
+    # Cada bridge simulado tiene las mismas habitaciones que la configuración por defecto
+    simuladores = []
+    for i in range(args.puentes):
+        sim = SimuladorHue.desde_habitaciones(
+            bot_hue.habitaciones,
+            tipos={"Terraza": "color", "Comedor": "color", "Baño": "dimmable"},
+            latencia=args.latencia_bridge,
+            jitter=args.jitter,
+            limite_por_segundo=args.limite_bridge
+        )
+        await sim.iniciar()
+        bot_hue.registrar_puente(
+            f"Puente {i + 1}", sim.direccion, "benchmark", bot_hue.habitaciones, bot_hue.HABITACIONES_COLOR,
+            eventstream=args.eventstream, eventstream_url=f"http://{sim.direccion}/eventstream/clip/v2"
+        )
+        simuladores.append(sim)
+    bot_hue.DB_PATH = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    bot_hue.METRICAS_PUERTO = None
+    for i in range(args.chats):
+        bot_hue.registrar_usuario(1000 + i, "member")
+    renders = contar_renders()
+
+    app = AplicacionFalsa(BotFalso(args.latencia_telegram, args.flood))
+    await bot_hue.iniciar_bot(app)
+    peticiones_iniciales = sum(sum(sim.contadores.values()) for sim in simuladores)
+    lecturas_iniciales = contar_lecturas(simuladores)
+    renders["renders"] = 0
+
+    inicio = time.monotonic()
+    fin = inicio + args.duracion
+    await asyncio.gather(*(simular_chat(app, 1000 + i, args.taps, fin) for i in range(args.chats)))
+    duracion = time.monotonic() - inicio
+    # Se deja terminar lo que quedaba en las colas
+    await asyncio.sleep(2)
+
+    total_telegram = sum(app.bot.llamadas.values())
+    peticiones = sum(sum(sim.contadores.values()) for sim in simuladores) - peticiones_iniciales
+    lecturas = contar_lecturas(simuladores) - lecturas_iniciales
+    rechazadas = sum(sim.rechazadas for sim in simuladores)
+    print(f"Bridges: {args.puentes}  habitaciones: {len(bot_hue.HABITACIONES)}")
+    print(f"Chats: {args.chats}  taps/s por chat: {args.taps}  duración: {duracion:.1f}s")
+    print(f"Latencia tap→edición  p50: {percentil(app.bot.latencias, 50) * 1000:.0f} ms"
+          f"  p99: {percentil(app.bot.latencias, 99) * 1000:.0f} ms  (n={len(app.bot.latencias)})")
+    print(f"Renders: {renders['renders']}  lecturas al bridge por render: {lecturas / max(renders['renders'], 1):.2f}")
+    print(f"Peticiones al bridge: {peticiones}  ({peticiones / duracion:.1f}/s, rechazadas: {rechazadas})")
+    print(f"Llamadas a Telegram por minuto: {total_telegram / duracion * 60:.0f}  {app.bot.llamadas}")
+    for sim in simuladores:
+        print(f"Detalle bridge {sim.direccion}: {sim.contadores}")
+
+    await bot_hue.detener_bot(app)
+    for sim in simuladores:
+        await sim.detener()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del bot de Hue contra un bridge simulado")
+    parser.add_argument("--puentes", type=int, default=1, help="Bridges simulados")
+    parser.add_argument("--chats", type=int, default=10, help="Chats con el panel abierto")
+    parser.add_argument("--taps", type=float, default=1.0, help="Taps por segundo en cada chat")
+    parser.add_argument("--duracion", type=float, default=20, help="Segundos de carga")
+    parser.add_argument("--latencia-bridge", type=float, default=0.03)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--limite-bridge", type=float, default=None, help="Escrituras/s antes de devolver 429")
+    parser.add_argument("--latencia-telegram", type=float, default=0.05)
+    parser.add_argument("--flood", type=float, default=None, help="Intervalo mínimo por chat antes de RetryAfter")
+    parser.add_argument("--eventstream", action="store_true", help="Usar el eventstream en vez de sondear")
+    asyncio.run(ejecutar(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import random
+import time
+
+# ─────────────────────────────────────────────────────────────
+# Bridge Philips Hue simulado (API v1 + eventstream de la API v2)
+#
+# Servidor HTTP mínimo en el propio proceso para medir el bot sin un bridge
+# real: luces, grupos, escenas, latencia y jitter configurables y errores por
+# exceso de peticiones como los que devuelve el bridge cuando se le satura.
+# ─────────────────────────────────────────────────────────────
+
+TIPOS_LUZ = {
+    "color": {
+        "type": "Extended color light",
+        "capabilities": {"control": {"colorgamuttype": "C", "ct": {"min": 153, "max": 500}}}
+    },
+    "ct": {
+        "type": "Color temperature light",
+        "capabilities": {"control": {"ct": {"min": 153, "max": 454}}}
+    },
+    "dimmable": {
+        "type": "Dimmable light",
+        "capabilities": {"control": {}}
+    }
+}
+
+class SimuladorHue:
+
+    def __init__(self, latencia=0.02, jitter=0.01, limite_por_segundo=None):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.limite_por_segundo = limite_por_segundo
+        self.luces = {}
+        self.grupos = {}
+        self.escenas = {}
+        self.contadores = {}      # "METODO recurso" -> número de peticiones
+        self.rechazadas = 0       # Peticiones respondidas con 429
+        self._tokens = limite_por_segundo or 0
+        self._ultimo = time.monotonic()
+        self._suscriptores = set()
+        self._servidor = None
+        self.puerto = None
+
+    @classmethod
+    def desde_habitaciones(cls, habitaciones, tipos=None, **kwargs):
+        # `tipos` asigna "color", "ct" o "dimmable" por habitación (por defecto "ct")
+        sim = cls(**kwargs)
+        tipos = tipos or {}
+        for habitacion, luces in habitaciones.items():
+            for luz_id in luces:
+                sim.agregar_luz(luz_id, f"{habitacion} {luz_id}", tipos.get(habitacion, "ct"))
+        return sim
+
+    def agregar_luz(self, luz_id, nombre, tipo="ct"):
+        estado = {"on": False, "bri": 254, "alert": "none", "reachable": True}
+        if tipo in ("ct", "color"):
+            estado.update({"ct": 366, "colormode": "ct"})
+        if tipo == "color":
+            estado.update({"hue": 8417, "sat": 140, "xy": [0.4573, 0.41]})
+        self.luces[str(luz_id)] = {
+            "state": estado,
+            "type": TIPOS_LUZ[tipo]["type"],
+            "name": nombre,
+            "capabilities": json.loads(json.dumps(TIPOS_LUZ[tipo]["capabilities"]))
+        }
+
+    # ── Ciclo de vida ────────────────────────────────────────
+
+    async def iniciar(self, host="127.0.0.1", puerto=0):
+        self._servidor = await asyncio.start_server(self._atender, host, puerto)
+        self.puerto = self._servidor.sockets[0].getsockname()[1]
+        return self.puerto
+
+    async def detener(self):
+        for cola in list(self._suscriptores):
+            cola.put_nowait(None)
+        if self._servidor:
+            self._servidor.close()
+            await self._servidor.wait_closed()
+
+    @property
+    def direccion(self):
+        return f"127.0.0.1:{self.puerto}"
+
+    # ── Cambios externos (interruptores, app de Hue) ─────────
+
+    def cambiar_luz(self, luz_id, **estado):
+        self._aplicar_a_luz(str(luz_id), estado)
+
+    # ── Servidor HTTP ────────────────────────────────────────
+
+    async def _atender(self, reader, writer):
+        try:
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                metodo, ruta, _ = linea.decode().split(" ", 2)
+                cabeceras = {}
+                while True:
+                    cabecera = await reader.readline()
+                    if cabecera in (b"\r\n", b"\n", b""):
+                        break
+                    nombre, valor = cabecera.decode().split(":", 1)
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+                cuerpo = b""
+                if "content-length" in cabeceras:
+                    cuerpo = await reader.readexactly(int(cabeceras["content-length"]))
+                if ruta.startswith("/eventstream/"):
+                    await self._servir_eventos(writer)
+                    break
+                status, respuesta = await self._responder(metodo, ruta, cuerpo)
+                datos = json.dumps(respuesta).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(datos)}\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode() + datos
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _hay_capacidad(self):
+        if not self.limite_por_segundo:
+            return True
+        ahora = time.monotonic()
+        self._tokens = min(self.limite_por_segundo, self._tokens + (ahora - self._ultimo) * self.limite_por_segundo)
+        self._ultimo = ahora
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def _responder(self, metodo, ruta, cuerpo):
+        partes = [p for p in ruta.split("?")[0].split("/") if p]
+        # /api/<usuario>/<recurso>/...
+        recurso = partes[2:] if len(partes) > 2 and partes[0] == "api" else []
+        clave = f"{metodo} {recurso[0] if recurso else ruta}"
+        if len(recurso) > 2:
+            clave += f"/{recurso[2]}"
+        self.contadores[clave] = self.contadores.get(clave, 0) + 1
+        await asyncio.sleep(max(0, self.latencia + random.uniform(-self.jitter, self.jitter)))
+        if metodo != "GET" and not self._hay_capacidad():
+            self.rechazadas += 1
+            return 429, [{"error": {"type": 901, "address": ruta, "description": "Too many requests"}}]
+        datos = json.loads(cuerpo) if cuerpo else {}
+        try:
+            return 200, self._enrutar(metodo, recurso, datos)
+        except (KeyError, IndexError):
+            return 404, [{"error": {"type": 3, "address": ruta, "description": "resource not available"}}]
+
+    def _enrutar(self, metodo, recurso, datos):
+        tipo = recurso[0]
+        if metodo == "GET":
+            coleccion = {"lights": self.luces, "groups": self.grupos, "scenes": self.escenas}[tipo]
+            return coleccion[recurso[1]] if len(recurso) > 1 else coleccion
+        if metodo == "PUT" and tipo == "lights":
+            return self._aplicar_a_luz(recurso[1], datos)
+        if metodo == "PUT" and tipo == "groups":
+            luces = list(self.luces) if recurso[1] == "0" else self.grupos[recurso[1]]["lights"]
+            if "scene" in datos:
+                for luz_id, estado in self.escenas[datos["scene"]]["lightstates"].items():
+                    self._aplicar_a_luz(luz_id, estado)
+            else:
+                for luz_id in luces:
+                    self._aplicar_a_luz(luz_id, datos)
+            return [{"success": {f"/groups/{recurso[1]}/action/{k}": v}} for k, v in datos.items()]
+        if metodo == "POST" and tipo in ("groups", "scenes"):
+            coleccion = self.grupos if tipo == "groups" else self.escenas
+            nuevo_id = str(max([int(i) for i in coleccion if i.isdigit()] + [0]) + 1)
+            coleccion[nuevo_id] = {"name": datos.get("name", nuevo_id), **datos}
+            return [{"success": {"id": nuevo_id}}]
+        if metodo == "DELETE" and tipo == "scenes":
+            del self.escenas[recurso[1]]
+            return [{"success": f"/scenes/{recurso[1]} deleted"}]
+        raise KeyError(tipo)
+
+    def _aplicar_a_luz(self, luz_id, datos):
+        luz = self.luces[luz_id]
+        estado = luz["state"]
+        control = luz["capabilities"]["control"]
+        for atributo, valor in datos.items():
+            if atributo == "bri_inc":
+                estado["bri"] = min(254, max(1, estado.get("bri", 1) + valor))
+            elif atributo == "ct_inc" and "ct" in control:
+                estado["ct"] = min(control["ct"]["max"], max(control["ct"]["min"], estado.get("ct", 366) + valor))
+            elif atributo == "ct" and "ct" not in control:
+                continue
+            elif atributo in ("hue", "sat", "xy") and "colorgamuttype" not in control:
+                continue
+            elif atributo in estado or atributo in ("on", "bri", "ct", "hue", "sat"):
+                estado[atributo] = valor
+        self._publicar(luz_id, estado)
+        return [{"success": {f"/lights/{luz_id}/state/{k}": v}} for k, v in datos.items()]
+
+    # ── Eventstream (SSE) ────────────────────────────────────
+
+    def _publicar(self, luz_id, estado):
+        if not self._suscriptores:
+            return
+        recurso = {
+            "id": f"luz-{luz_id}",
+            "id_v1": f"/lights/{luz_id}",
+            "type": "light",
+            "on": {"on": estado["on"]},
+            "dimming": {"brightness": round(estado.get("bri", 0) * 100 / 254, 2)}
+        }
+        if "ct" in estado:
+            recurso["color_temperature"] = {"mirek": estado["ct"]}
+        evento = [{"type": "update", "creationtime": time.strftime("%Y-%m-%dT%H:%M:%SZ"), "data": [recurso]}]
+        for cola in self._suscriptores:
+            cola.put_nowait(evento)
+
+    async def _servir_eventos(self, writer):
+        cola = asyncio.Queue()
+        self._suscriptores.add(cola)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Connection: close\r\n\r\n"
+                b": hi\n\n"
+            )
+            await writer.drain()
+            while True:
+                evento = await cola.get()
+                if evento is None:
+                    break
+                writer.write(f"id: {time.time()}\ndata: {json.dumps(evento)}\n\n".encode())
+                await writer.drain()
+        finally:
+            self._suscriptores.discard(cola)
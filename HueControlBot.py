@@ -1,14 +1,56 @@
 import asyncio
+import datetime
+import functools
+import heapq
+import itertools
+import json
 import logging
-import requests
+import math
+import os
+import re
+import sqlite3
+import time
+import tomllib
+import httpx
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, CallbackContext, filters
 
 # 📌 Configuración del bot de Telegram y API de Philips Hue
+# Si existe HUE_CONFIG_PATH se usan los bridges y habitaciones definidos allí;
+# si no, un único bridge con HUE_BRIDGE_IP, HUE_USERNAME y `habitaciones`.
+HUE_CONFIG_PATH = "huecontrolbot.toml"
 TELEGRAM_BOT_TOKEN = ""
 HUE_BRIDGE_IP = "192.168.0.191"
 HUE_USERNAME = ""
+HUE_CACHE_TTL = 5  # Segundos que se reutiliza el snapshot de luces entre chats y jobs
+HUE_HTTP_TIMEOUT = 5  # Timeout por petición al bridge (segundos)
+HUE_MAX_CONEXIONES = 4  # Conexiones keep-alive y peticiones simultáneas al bridge
+HUE_ESCRITURAS_POR_SEGUNDO = 10  # El bridge admite unos 10 comandos/s a luces...
+HUE_COSTE_GRUPO = 5              # ...y bastantes menos a grupos, que cuestan más tokens
+HUE_REINTENTOS_SATURACION = 3    # Reintentos cuando el bridge responde que está saturado
+HUE_USAR_EVENTSTREAM = False  # Actualiza los paneles con los eventos del bridge (API v2) en vez de sondear
+HUE_EVENTSTREAM_URL = None    # Por defecto https://<HUE_BRIDGE_IP>/eventstream/clip/v2
+TELEGRAM_EDICIONES_POR_SEGUNDO = 25  # Límite global de ediciones (Telegram corta en ~30/s)
+TELEGRAM_INTERVALO_CHAT = 1.0        # Segundos mínimos entre ediciones en un mismo chat
+DB_PATH = "huecontrolbot.db"  # Estado persistente de los paneles abiertos
+METRICAS_HOST = "127.0.0.1"
+METRICAS_PUERTO = 9108  # Endpoint /metrics en formato Prometheus (None para desactivarlo)
+PANEL_TAMANO_PAGINA = 8  # Habitaciones por página en el panel principal
+PANEL_INTERVALO_REFRESCO = 10  # Segundos entre refrescos de los paneles abiertos
+ADMINISTRADORES = []  # Ids de usuario de Telegram con control total si no hay huecontrolbot.toml
+LATITUD = 40.4168    # Ubicación para calcular la salida y la puesta de sol sin conexión
+LONGITUD = -3.7038
+AGENDA_VENTANA = 0.25    # Acciones que vencen con menos de esta separación (s) se envían juntas
+HISTORIAL_INTERVALO = 10      # Segundos entre muestras del estado para el historial de consumo
+HISTORIAL_DIAS_HORAS = 31     # Días que se guardan los totales por hora (los diarios no caducan)
+HUE_VATIOS_LUZ = 9.0          # Consumo estimado de una bombilla al 100 % (W)
+AGENDA_GRACIA = 300      # Acciones vencidas con el bot parado que aún se ejecutan al arrancar (s)
+HUE_TRANSICION_PASO = 4   # Décimas de segundo de fundido en cada paso de brillo o tono
+PASO_BRILLO = 64          # bri_inc de los botones Brillo +/- (25 %)
+PASO_CT = 20              # ct_inc en mireds de los botones de tono
+HUE_INTERVALO_CAPACIDADES = 3600  # Segundos entre relecturas de las capacidades de las luces
 
 # 📌 Habitaciones y sus luces
 habitaciones = {
@@ -21,12 +63,20 @@ habitaciones = {
     "Habitación PC": [39],
     "Comedor": [36, 31, 11, 12, 13, 14]
 }
+HABITACIONES_COLOR = ["Terraza", "Comedor"]  # Luces de color hasta conocer las capacidades del bridge
 
 # Diccionarios globales para gestionar estados y jobs
-PANEL_STATES = {}       # Estado actual del panel por chat_id ("main", "room:<habitacion>", "color:<habitacion>")
-PANEL_LAST_STATE = {}   # Último texto y markup enviado (para evitar actualizaciones innecesarias)
-PANEL_JOBS = {}         # Job de actualización periódica por chat_id
+PANEL_STATES = {}       # Estado actual del panel por chat_id ("main:<pagina>", "room:<habitacion>", "color:<habitacion>")
+PANEL_LAST_STATE = {}   # Panel, huellas por habitación y filas ya construidas del último envío
+PANEL_MENSAJES = {}     # message_id del panel abierto por chat_id
+PANEL_USUARIOS = {}     # Quién abrió el panel de cada chat: el menú principal solo muestra lo que él puede ver
+VISTAS = {}             # Filas ya construidas por vista (panel y habitaciones visibles), compartidas entre chats
 EXPIRATION_JOBS = {}    # Job de expiración del panel por chat_id
+PUENTES = {}            # Bridges configurados por nombre
+HABITACIONES = {}       # Registro de habitaciones por nombre: bridge, grupo, luces y capacidades
+HABITACIONES_POR_LUZ = {}  # (bridge, luz_id) -> habitaciones que contienen esa luz
+USUARIOS = {}           # user_id -> {"rol", "habitaciones"} con permiso para usar el bot
+ESCENAS = {}            # habitación -> {nombre: escena guardada}, copia en memoria de la tabla `escenas`
 
 # 📌 Configuración del logger
 logging.basicConfig(
@@ -34,92 +84,1012 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# ─────────────────────────────────────────────────────────────
+# Métricas (formato de texto de Prometheus, sin dependencias)
+# ─────────────────────────────────────────────────────────────
+
+REGISTRO_METRICAS = []
+
+def formatear_etiquetas(clave, extra=()):
+    pares = list(clave) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pares) + "}"
+
+class Contador:
+
+    def __init__(self, nombre, ayuda):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.valores = {}
+        REGISTRO_METRICAS.append(self)
+
+    def inc(self, valor=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        self.valores[clave] = self.valores.get(clave, 0) + valor
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        for clave, valor in self.valores.items():
+            lineas.append(f"{self.nombre}{formatear_etiquetas(clave)} {valor}")
+        return lineas
+
+class Histograma:
+
+    LIMITES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, nombre, ayuda):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.series = {}  # clave de etiquetas -> [cuentas por límite, suma, total]
+        REGISTRO_METRICAS.append(self)
+
+    def observar(self, valor, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        serie = self.series.setdefault(clave, [[0] * len(self.LIMITES), 0.0, 0])
+        for i, limite in enumerate(self.LIMITES):
+            if valor <= limite:
+                serie[0][i] += 1
+        serie[1] += valor
+        serie[2] += 1
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        for clave, (cuentas, suma, total) in self.series.items():
+            for limite, cuenta in zip(self.LIMITES, cuentas):
+                lineas.append(f"{self.nombre}_bucket{formatear_etiquetas(clave, [('le', limite)])} {cuenta}")
+            lineas.append(f"{self.nombre}_bucket{formatear_etiquetas(clave, [('le', '+Inf')])} {total}")
+            lineas.append(f"{self.nombre}_sum{formatear_etiquetas(clave)} {suma}")
+            lineas.append(f"{self.nombre}_count{formatear_etiquetas(clave)} {total}")
+        return lineas
+
+class Medidor:
+    # Gauge cuyo valor se calcula al exportar
+
+    def __init__(self, nombre, ayuda, funcion):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+        REGISTRO_METRICAS.append(self)
+
+    def exportar(self):
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} gauge",
+                f"{self.nombre} {self.funcion()}"]
+
+def exportar_metricas():
+    return "\n".join(linea for metrica in REGISTRO_METRICAS for linea in metrica.exportar()) + "\n"
+
+BRIDGE_LATENCIA = Histograma("hue_bridge_peticion_segundos", "Latencia de las peticiones al bridge por endpoint")
+BRIDGE_ERRORES = Contador("hue_bridge_errores_total", "Errores y timeouts de las peticiones al bridge")
+PANEL_RENDER = Histograma("hue_panel_render_segundos", "Tiempo de generación de cada tipo de panel")
+TELEGRAM_EDICION = Histograma("hue_telegram_edicion_segundos", "Latencia de edit_message_text")
+TELEGRAM_NO_MODIFICADO = Contador("hue_telegram_no_modificado_total", "Ediciones rechazadas con \"Message is not modified\"")
+TELEGRAM_RETRY_AFTER = Contador("hue_telegram_retry_after_total", "Ediciones frenadas por RetryAfter")
+PANEL_OMITIDO = Contador("hue_panel_refresco_omitido_total", "Refrescos descartados porque no cambió ninguna huella")
+Medidor("hue_paneles_abiertos", "Paneles abiertos", lambda: len(PANEL_STATES))
+Medidor("hue_jobs_programados", "Jobs programados en la job_queue",
+        lambda: len(APLICACION.job_queue.jobs()) if APLICACION else 0)
+Medidor("hue_vistas_distintas", "Vistas distintas entre los paneles abiertos", lambda: len({vista_de_chat(c) for c in PANEL_STATES}))
+
+def endpoint_hue(url):
+    # "http://ip/api/<usuario>/lights/12/state" -> "lights/{id}/state"
+    ruta = url.split("/api/", 1)[-1].split("/")[1:]
+    return "/".join("{id}" if parte.isdigit() else parte for parte in ruta) or "/"
+
+def medir_peticion_hue(metodo, url, inicio, status=None, error=None):
+    endpoint = endpoint_hue(url)
+    BRIDGE_LATENCIA.observar(time.monotonic() - inicio, metodo=metodo, endpoint=endpoint)
+    if isinstance(error, httpx.TimeoutException):
+        BRIDGE_ERRORES.inc(endpoint=endpoint, tipo="timeout")
+    elif error is not None:
+        BRIDGE_ERRORES.inc(endpoint=endpoint, tipo="conexion")
+    elif status is not None and status >= 400:
+        BRIDGE_ERRORES.inc(endpoint=endpoint, tipo=str(status))
+
+def medir_render(tipo):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def envoltorio(*args, **kwargs):
+            inicio = time.monotonic()
+            try:
+                return await funcion(*args, **kwargs)
+            finally:
+                PANEL_RENDER.observar(time.monotonic() - inicio, panel=tipo)
+        return envoltorio
+    return decorador
+
+async def servir_metricas(reader, writer):
+    try:
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        cuerpo = exportar_metricas().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(cuerpo)}\r\n".encode()
+            + b"Connection: close\r\n\r\n" + cuerpo
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
 # ─────────────────────────────────────────────────────────────
 # Funciones auxiliares para manejo seguro de peticiones HTTP
 # ─────────────────────────────────────────────────────────────
 
-def safe_get(url, timeout=5):
+# Cliente HTTP asíncrono con pool de conexiones persistentes hacia el bridge.
+# Se crea al primer uso para que quede ligado al event loop del bot.
+CLIENTE_HUE = None
+LIMITES_PETICIONES_HUE = {}  # Un semáforo por bridge para no saturar ninguno
+
+def cliente_hue():
+    global CLIENTE_HUE
+    if CLIENTE_HUE is None:
+        conexiones = HUE_MAX_CONEXIONES * max(len(PUENTES), 1)
+        CLIENTE_HUE = httpx.AsyncClient(
+            timeout=HUE_HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=conexiones,
+                max_keepalive_connections=conexiones,
+                keepalive_expiry=30
+            )
+        )
+    return CLIENTE_HUE
+
+def limite_peticiones(url):
+    host = url.split("://", 1)[-1].split("/", 1)[0]
+    if host not in LIMITES_PETICIONES_HUE:
+        LIMITES_PETICIONES_HUE[host] = asyncio.Semaphore(HUE_MAX_CONEXIONES)
+    return LIMITES_PETICIONES_HUE[host]
+
+async def cerrar_cliente_hue(app=None):
+    global CLIENTE_HUE
+    if CLIENTE_HUE is not None:
+        await CLIENTE_HUE.aclose()
+        CLIENTE_HUE = None
+
+async def safe_get(url, timeout=HUE_HTTP_TIMEOUT):
+    inicio = time.monotonic()
     try:
-        response = requests.get(url, timeout=timeout)
+        async with limite_peticiones(url):
+            response = await cliente_hue().get(url, timeout=timeout)
+        medir_peticion_hue("GET", url, inicio, status=response.status_code)
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
+        medir_peticion_hue("GET", url, inicio, error=e)
         logging.error(f"Error conectando con {url}: {e}")
         return None
 
-def safe_put(url, data, timeout=5):
+async def safe_put(url, data, timeout=HUE_HTTP_TIMEOUT):
+    # Devuelve el código HTTP de la respuesta, o None si no hubo conexión
+    inicio = time.monotonic()
     try:
-        requests.put(url, json=data, timeout=timeout)
-    except requests.exceptions.RequestException as e:
+        async with limite_peticiones(url):
+            response = await cliente_hue().put(url, json=data, timeout=timeout)
+        medir_peticion_hue("PUT", url, inicio, status=response.status_code)
+        if response.status_code >= 400:
+            logging.error(f"El bridge respondió {response.status_code} a {url}")
+        return response.status_code
+    except httpx.HTTPError as e:
+        medir_peticion_hue("PUT", url, inicio, error=e)
         logging.error(f"Error enviando datos a {url}: {e}")
+        return None
+
+async def safe_post(url, data, timeout=HUE_HTTP_TIMEOUT):
+    inicio = time.monotonic()
+    try:
+        async with limite_peticiones(url):
+            response = await cliente_hue().post(url, json=data, timeout=timeout)
+        medir_peticion_hue("POST", url, inicio, status=response.status_code)
+        return response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        medir_peticion_hue("POST", url, inicio, error=e)
+        logging.error(f"Error enviando datos a {url}: {e}")
+        return None
+
+async def safe_delete(url, timeout=HUE_HTTP_TIMEOUT):
+    inicio = time.monotonic()
+    try:
+        async with limite_peticiones(url):
+            response = await cliente_hue().delete(url, timeout=timeout)
+        medir_peticion_hue("DELETE", url, inicio, status=response.status_code)
+        return response.status_code
+    except httpx.HTTPError as e:
+        medir_peticion_hue("DELETE", url, inicio, error=e)
+        logging.error(f"Error borrando {url}: {e}")
+        return None
 
 # ─────────────────────────────────────────────────────────────
-# Funciones para obtener estado, brillo y ct de las luces
+# Snapshot del bridge y cálculo de estado, brillo y ct
 # ─────────────────────────────────────────────────────────────
 
-async def obtener_estado_habitacion(habitacion):
-    for luz_id in habitaciones[habitacion]:
-        url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-        response = safe_get(url)
-        if response and response["state"]["on"]:
+async def leer_snapshot_bridge(puente):
+    # Una sola petición a /lights devuelve el estado de todas las luces del bridge
+    response = await safe_get(puente.url("lights"))
+    if not isinstance(response, dict):
+        # El bridge responde con una lista de errores si el usuario no es válido
+        return {}
+    # La respuesta trae también el tipo y las capacidades: el índice se renueva gratis
+    indexar_capacidades(puente, response)
+    return response
+
+class CacheEstadoLuces:
+    # Cache de un bridge compartida por todos los chats y jobs: un snapshot vale
+    # durante `ttl` segundos y las lecturas concurrentes esperan a la misma petición.
+
+    def __init__(self, ttl, leer):
+        self.ttl = ttl
+        self.leer = leer
+        # Con el eventstream conectado el espejo se mantiene al día y no caduca
+        self.espejo_activo = False
+        self._snapshot = None
+        self._instante = 0.0
+        self._version = 0
+        self._en_vuelo = None
+
+    def invalidar(self):
+        self._snapshot = None
+        self._version += 1
+        # Una lectura lanzada antes de la escritura podría devolver el estado antiguo
+        self._en_vuelo = None
+
+    def aplicar_cambios(self, luz_id, cambios):
+        # Actualiza el espejo local con un cambio recibido del bridge sin volver a leerlo
+        if self._snapshot is None or str(luz_id) not in self._snapshot:
+            # Una lectura en curso podría ser anterior al evento: se descarta
+            self.invalidar()
+            return
+        self._snapshot = luces_con_parches(self._snapshot, {luz_id: cambios})
+
+    def aplicar_optimista(self, parches):
+        # Refleja en la cache el estado que acabamos de pedir al bridge, antes de que
+        # se envíe; las lecturas lanzadas antes ya no pueden sobrescribirlo.
+        if self._snapshot is None:
+            self.invalidar()
+            return
+        self._snapshot = luces_con_parches(self._snapshot, parches)
+        self._version += 1
+        self._en_vuelo = None
+
+    async def obtener(self):
+        if self._snapshot is not None and (
+            self.espejo_activo or time.monotonic() - self._instante < self.ttl
+        ):
+            return self._snapshot
+        if self._en_vuelo is None:
+            self._en_vuelo = asyncio.ensure_future(self._leer())
+        return await asyncio.shield(self._en_vuelo)
+
+    async def _leer(self):
+        version = self._version
+        tarea = asyncio.current_task()
+        try:
+            snapshot = await self.leer()
+        finally:
+            if self._en_vuelo is tarea:
+                self._en_vuelo = None
+        if snapshot and version == self._version:
+            self._snapshot = snapshot
+            self._instante = time.monotonic()
+        return snapshot
+
+def luces_con_parches(luces, parches):
+    # Copia de las luces de un bridge con `parches` ({luz_id: estado parcial}) aplicados
+    nuevo = dict(luces)
+    for luz_id, parche in parches.items():
+        luz = nuevo.get(str(luz_id))
+        if luz is None:
+            continue
+        luz = dict(luz)
+        luz["state"] = {**luz.get("state", {}), **parche}
+        nuevo[str(luz_id)] = luz
+    return nuevo
+
+def parches_por_puente(parches):
+    # {(bridge, luz_id): parche} -> {bridge: {luz_id: parche}}
+    agrupados = {}
+    for (puente, luz_id), parche in parches.items():
+        agrupados.setdefault(puente, {})[luz_id] = parche
+    return agrupados
+
+def snapshot_con_parches(snapshot, parches):
+    # `snapshot` es {bridge: luces} y `parches` {(bridge, luz_id): estado parcial}
+    nuevo = dict(snapshot)
+    for puente, parches_puente in parches_por_puente(parches).items():
+        if puente in nuevo:
+            nuevo[puente] = luces_con_parches(nuevo[puente], parches_puente)
+    return nuevo
+
+def parches_habitacion(habitacion, parche):
+    # El parche optimista de cada luz lleva solo lo que esa luz puede aplicar
+    hab = HABITACIONES[habitacion]
+    return {(hab.puente.nombre, luz_id): filtrar_parche(hab.puente, luz_id, parche) for luz_id in hab.luces}
+
+def parches_incremento(snapshot, habitacion, atributo, paso):
+    # Estado que dejará un `<atributo>_inc` en cada luz, para la UI optimista
+    hab = HABITACIONES[habitacion]
+    parches = {}
+    for luz_id, estado in luces_en_snapshot(snapshot, habitacion):
+        capacidad = "ct" if atributo == "ct" else "brillo"
+        if not admite(hab.puente, luz_id, capacidad):
+            continue
+        minimo, maximo = rango_ct(hab.puente, luz_id) if atributo == "ct" else (1, 254)
+        actual = estado.get(atributo, (minimo + maximo) // 2)
+        parches[(hab.puente.nombre, luz_id)] = {"on": True, atributo: min(maximo, max(minimo, actual + paso))}
+    return parches
+
+async def obtener_snapshot_luces(nombres=None):
+    # Snapshot {bridge: luces} de los bridges que contienen las habitaciones pedidas
+    # (todos si no se indica ninguna): un /lights por bridge como mucho.
+    if nombres is None:
+        puentes = list(PUENTES.values())
+    else:
+        puentes = list({HABITACIONES[h].puente.nombre: HABITACIONES[h].puente for h in nombres if h in HABITACIONES}.values())
+    snapshots = await asyncio.gather(*(puente.cache.obtener() for puente in puentes))
+    return {puente.nombre: snapshot for puente, snapshot in zip(puentes, snapshots)}
+
+def luces_en_snapshot(snapshot, habitacion):
+    hab = HABITACIONES.get(habitacion)
+    if hab is None:
+        return
+    luces = snapshot.get(hab.puente.nombre, {})
+    for luz_id in hab.luces:
+        luz = luces.get(str(luz_id))
+        if luz and "state" in luz:
+            yield luz_id, luz["state"]
+
+def estado_habitacion(snapshot, habitacion):
+    for _, estado in luces_en_snapshot(snapshot, habitacion):
+        if estado["on"]:
             return "🟡"
     return "⚫️"
 
-async def obtener_brillo_habitacion(habitacion):
+def brillo_habitacion(snapshot, habitacion):
     total_bri = 0
     count = 0
-    for luz_id in habitaciones[habitacion]:
-        url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-        response = safe_get(url)
-        if response:
-            if response["state"]["on"]:
-                bri = response["state"].get("bri", 0)
-                porcentaje = int(bri * 100 / 254)
-            else:
-                porcentaje = 0
-            total_bri += porcentaje
-            count += 1
+    for _, estado in luces_en_snapshot(snapshot, habitacion):
+        if estado["on"]:
+            porcentaje = int(estado.get("bri", 0) * 100 / 254)
+        else:
+            porcentaje = 0
+        total_bri += porcentaje
+        count += 1
     return total_bri // count if count else 0
 
-async def obtener_ct_habitacion(habitacion):
+def ct_habitacion(snapshot, habitacion):
     total_ct = 0
     count = 0
-    for luz_id in habitaciones[habitacion]:
-        url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-        response = safe_get(url)
-        if response and response["state"]["on"] and "ct" in response["state"]:
-            total_ct += response["state"]["ct"]
+    for _, estado in luces_en_snapshot(snapshot, habitacion):
+        if estado["on"] and "ct" in estado:
+            total_ct += estado["ct"]
             count += 1
     return total_ct // count if count else None
 
+def huella_habitacion(snapshot, habitacion, panel_actual="main:0"):
+    # Lo que `panel_actual` muestra de una habitación: si cambia, hay que repintarlo.
+    # Un cambio que el panel no muestra no debe provocar una edición ("Message is not modified").
+    if panel_actual.startswith("color:"):
+        # Solo el panel de temperatura muestra un valor del bridge; el de color es fijo
+        capacidades = HABITACIONES[habitacion].capacidades
+        return (ct_habitacion(snapshot, habitacion),) if "ct" in capacidades and "color" not in capacidades else ()
+    # Menú principal y panel de habitación: encendida y brillo
+    return estado_habitacion(snapshot, habitacion), brillo_habitacion(snapshot, habitacion)
+
+# ─────────────────────────────────────────────────────────────
+# Planificador de escrituras al bridge
+# ─────────────────────────────────────────────────────────────
+
+class CuboTokens:
+    # Token bucket: `tasa` tokens por segundo con ráfagas de hasta `capacidad`
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._tokens = capacidad
+        self._ultimo = time.monotonic()
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    async def tomar(self, coste=1):
+        self._rellenar()
+        while self._tokens < coste:
+            await asyncio.sleep((coste - self._tokens) / self.tasa)
+            self._rellenar()
+        self._tokens -= coste
+
+def es_url_grupo(url):
+    return "/groups/" in url
+
+# Atributos relativos, su absoluto y el rango en que el bridge lo recorta
+INCREMENTOS = {"bri_inc": ("bri", 1, 254), "ct_inc": ("ct", 153, 500), "sat_inc": ("sat", 0, 254)}
+
+def fusionar_parches(pendiente, nuevo):
+    # Como `update`, pero dos incrementos se suman y un incremento sobre un valor
+    # absoluto pendiente se resuelve aquí: el resultado es el de enviar ambos en orden.
+    for atributo, valor in nuevo.items():
+        if atributo in INCREMENTOS:
+            absoluto, minimo, maximo = INCREMENTOS[atributo]
+            if absoluto in pendiente:
+                pendiente[absoluto] = min(maximo, max(minimo, pendiente[absoluto] + valor))
+                continue
+            valor = min(maximo, max(-maximo, valor + pendiente.get(atributo, 0)))
+        elif atributo in (datos[0] for datos in INCREMENTOS.values()):
+            # Un valor absoluto anula cualquier incremento pendiente del mismo atributo
+            for incremento, datos in INCREMENTOS.items():
+                if datos[0] == atributo:
+                    pendiente.pop(incremento, None)
+        pendiente[atributo] = valor
+    return pendiente
+
+class ProgramadorEscrituras:
+    # Todas las escrituras pasan por aquí. Los parches pendientes para el mismo
+    # recurso se fusionan (gana el último valor de cada atributo) y se envían en
+    # orden de llegada respetando el límite de comandos del bridge.
+
+    def __init__(self, cubo, cache):
+        self.cubo = cubo
+        self.cache = cache
+        self._cola = {}       # clave -> [url, parche, futuros], en orden de llegada
+        self._ultima = {}     # url -> clave de su entrada pendiente más reciente
+        self._claves = itertools.count()
+        self._tarea = None
+
+    def _fusionable(self, clave, url, parche):
+        # Solo se fusiona si ninguna entrada posterior puede pisar al mismo recurso:
+        # un grupo solapa con cualquier luz, dos luces solo si son la misma.
+        if "scene" in parche or "scene" in self._cola[clave][1]:
+            # Una escena no es un conjunto de atributos: fusionarla cambiaría el resultado
+            return False
+        posterior = False
+        for otra, (otra_url, _, _) in self._cola.items():
+            if otra == clave:
+                posterior = True
+            elif posterior and (otra_url == url or es_url_grupo(otra_url) or es_url_grupo(url)):
+                return False
+        return posterior
+
+    def enviar(self, url, parche):
+        futuro = asyncio.get_running_loop().create_future()
+        clave = self._ultima.get(url)
+        if clave in self._cola and self._fusionable(clave, url, parche):
+            entrada = self._cola[clave]
+            fusionar_parches(entrada[1], parche)
+            entrada[2].append(futuro)
+        else:
+            clave = next(self._claves)
+            self._cola[clave] = [url, dict(parche), [futuro]]
+            self._ultima[url] = clave
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._procesar())
+        return futuro
+
+    async def _procesar(self):
+        while self._cola:
+            clave = next(iter(self._cola))
+            url = self._cola[clave][0]
+            await self.cubo.tomar(HUE_COSTE_GRUPO if es_url_grupo(url) else 1)
+            # Se saca de la cola después de esperar: lo que llegue mientras tanto se fusiona
+            url, parche, futuros = self._cola.pop(clave)
+            if self._ultima.get(url) == clave:
+                del self._ultima[url]
+            status = None
+            try:
+                for intento in range(HUE_REINTENTOS_SATURACION + 1):
+                    status = await safe_put(url, parche)
+                    if status not in (429, 503):
+                        break
+                    await asyncio.sleep(0.5 * (intento + 1))
+            except Exception as e:
+                logging.error(f"Error procesando escritura a {url}: {e}")
+            finally:
+                # Sondeando, tras una escritura el estado cacheado deja de ser fiable. Con el
+                # eventstream el espejo ya lleva el parche optimista y los eventos de esta
+                # escritura lo corrigen; solo se descarta si la escritura falló.
+                if not self.cache.espejo_activo or status is None or status >= 400:
+                    self.cache.invalidar()
+                for futuro in futuros:
+                    if not futuro.done():
+                        futuro.set_result(None)
+
+def enviar_a_luz(puente, luz_id, data):
+    # Devuelve un futuro que se completa cuando la escritura llega al bridge
+    return puente.programador.enviar(puente.url(f"lights/{luz_id}/state"), filtrar_parche(puente, luz_id, data))
+
+# ─────────────────────────────────────────────────────────────
+# Índice de capacidades de las luces
+# ─────────────────────────────────────────────────────────────
+
+# Atributos de estado que solo aceptan las luces con cada capacidad
+ATRIBUTOS_CAPACIDAD = {
+    "bri": "brillo", "bri_inc": "brillo",
+    "ct": "ct", "ct_inc": "ct",
+    "hue": "color", "sat": "color", "xy": "color", "hue_inc": "color", "sat_inc": "color"
+}
+
+def capacidades_luz(luz):
+    # {"tipo", "brillo", "color", "ct": (min, max) o None} a partir de los metadatos de /lights
+    control = luz.get("capabilities", {}).get("control", {})
+    estado = luz.get("state", {})
+    ct = control.get("ct")
+    if ct:
+        rango_ct = (ct.get("min", 153), ct.get("max", 500))
+    elif "ct" in estado:
+        # Bridges antiguos sin `capabilities`: basta con que el estado tenga ct
+        rango_ct = (153, 500)
+    else:
+        rango_ct = None
+    return {
+        "tipo": luz.get("type", ""),
+        "brillo": "bri" in estado or "maxlumen" in control,
+        "color": "colorgamuttype" in control or "hue" in estado or "xy" in estado,
+        "ct": rango_ct
+    }
+
+def indexar_capacidades(puente, luces):
+    puente.capacidades = {luz_id: capacidades_luz(luz) for luz_id, luz in luces.items()}
+
+async def actualizar_capacidades(puente):
+    response = await safe_get(puente.url("lights"))
+    if isinstance(response, dict):
+        indexar_capacidades(puente, response)
+    else:
+        logging.error(f"No se pudieron leer las capacidades de {puente.nombre}")
+
+async def actualizar_todas_capacidades(context=None):
+    # Las luces cambian poco (una bombilla nueva, un firmware): basta con releerlas de vez en cuando
+    await asyncio.gather(*(actualizar_capacidades(puente) for puente in PUENTES.values()))
+
+def admite(puente, luz_id, capacidad):
+    caps = puente.capacidades.get(str(luz_id))
+    if caps is None:
+        # Luz aún sin indexar: se deja pasar y el bridge ignorará lo que no admita
+        return True
+    return bool(caps[capacidad])
+
+def filtrar_parche(puente, luz_id, parche):
+    # Quita del parche los atributos que la luz no puede aplicar
+    return {
+        atributo: valor for atributo, valor in parche.items()
+        if atributo not in ATRIBUTOS_CAPACIDAD or admite(puente, luz_id, ATRIBUTOS_CAPACIDAD[atributo])
+    }
+
+def rango_ct(puente, luz_id):
+    caps = puente.capacidades.get(str(luz_id))
+    return caps["ct"] if caps and caps["ct"] else (153, 500)
+
+# ─────────────────────────────────────────────────────────────
+# Registro de bridges y habitaciones
+# ─────────────────────────────────────────────────────────────
+
+class Puente:
+
+    def __init__(self, nombre, ip, usuario, eventstream=False, eventstream_url=None):
+        self.nombre = nombre
+        self.ip = ip
+        self.usuario = usuario
+        self.eventstream = eventstream
+        self.eventstream_url = eventstream_url or f"https://{ip}/eventstream/clip/v2"
+        self.tarea_eventstream = None
+        self.capacidades = {}  # luz_id -> capacidades_luz(), renovado con cada lectura de /lights
+        self.cache = CacheEstadoLuces(HUE_CACHE_TTL, lambda: leer_snapshot_bridge(self))
+        self.programador = ProgramadorEscrituras(
+            CuboTokens(HUE_ESCRITURAS_POR_SEGUNDO, HUE_ESCRITURAS_POR_SEGUNDO),
+            self.cache
+        )
+
+    def url(self, ruta):
+        return f"http://{self.ip}/api/{self.usuario}/{ruta}"
+
+class Habitacion:
+
+    def __init__(self, nombre, puente, luces, capacidades=()):
+        self.nombre = nombre
+        self.puente = puente
+        self.luces = list(luces)
+        self.grupo_id = None
+        # Capacidades configuradas, usadas solo mientras el bridge no ha indexado las luces
+        self.capacidades_config = set(capacidades)
+
+    @property
+    def capacidades(self):
+        # Una habitación admite lo que admite alguna de sus luces
+        indexadas = [self.puente.capacidades[str(luz_id)] for luz_id in self.luces
+                     if str(luz_id) in self.puente.capacidades]
+        if not indexadas:
+            return self.capacidades_config | {"brillo"}
+        return {capacidad for capacidad in ("brillo", "color", "ct") if any(caps[capacidad] for caps in indexadas)}
+
+    def luces_con(self, capacidad):
+        return [luz_id for luz_id in self.luces if admite(self.puente, luz_id, capacidad)]
+
+TELEGRAM_MAX_CALLBACK = 64              # Bytes máximos del callback_data de un botón
+CALLBACK_MAS_LARGO = "setcolor:46920:254:"  # Prefijo más largo que lleva el nombre de una habitación
+
+def registrar_puente(nombre, ip, usuario, habitaciones_puente, color=(), eventstream=False, eventstream_url=None):
+    puente = PUENTES[nombre] = Puente(nombre, ip, usuario, eventstream, eventstream_url)
+    for nombre_habitacion, luces in habitaciones_puente.items():
+        # `color` usa los nombres tal como aparecen en la configuración del bridge
+        capacidades = {"color"} if nombre_habitacion in color else {"ct"}
+        if nombre_habitacion in HABITACIONES:
+            # Los nombres se usan en los botones: si se repiten entre bridges, la habitación
+            # del segundo pasa a llamarse "Nombre (bridge)" en el bot, /report y [[usuarios]]
+            logging.warning(f"{nombre_habitacion} ya existe en otro bridge: se usará como {nombre_habitacion} ({nombre})")
+            nombre_habitacion = f"{nombre_habitacion} ({nombre})"
+        if len(f"{CALLBACK_MAS_LARGO}{nombre_habitacion}".encode()) > TELEGRAM_MAX_CALLBACK:
+            # Telegram rechazaría el teclado entero y el panel no llegaría a pintarse
+            raise ValueError(f"Nombre de habitación demasiado largo para los botones: {nombre_habitacion}")
+        if ":" in nombre_habitacion:
+            # Los botones separan con ":" la acción y la habitación
+            raise ValueError(f"Nombre de habitación con \":\": {nombre_habitacion}")
+        HABITACIONES[nombre_habitacion] = Habitacion(nombre_habitacion, puente, luces, capacidades)
+        for luz_id in luces:
+            HABITACIONES_POR_LUZ.setdefault((nombre, luz_id), []).append(nombre_habitacion)
+    return puente
+
+def cargar_configuracion(ruta=HUE_CONFIG_PATH):
+    global TELEGRAM_BOT_TOKEN, LATITUD, LONGITUD
+    if not os.path.exists(ruta):
+        registrar_puente("Casa", HUE_BRIDGE_IP, HUE_USERNAME, habitaciones, HABITACIONES_COLOR,
+                         HUE_USAR_EVENTSTREAM, HUE_EVENTSTREAM_URL)
+        for user_id in ADMINISTRADORES:
+            registrar_usuario(user_id, "admin")
+        avisar_sin_usuarios()
+        return
+    with open(ruta, "rb") as f:
+        config = tomllib.load(f)
+    TELEGRAM_BOT_TOKEN = config.get("telegram", {}).get("token", TELEGRAM_BOT_TOKEN)
+    LATITUD = config.get("ubicacion", {}).get("latitud", LATITUD)
+    LONGITUD = config.get("ubicacion", {}).get("longitud", LONGITUD)
+    for datos in config.get("puentes", []):
+        registrar_puente(
+            datos["nombre"],
+            datos["ip"],
+            datos["usuario"],
+            datos.get("habitaciones", {}),
+            datos.get("color", []),
+            datos.get("eventstream", False),
+            datos.get("eventstream_url")
+        )
+    for datos in config.get("usuarios", []):
+        habitaciones_usuario = datos.get("habitaciones")
+        # Con una tabla {habitación = rol}, sin `rol` no hay acceso al resto de habitaciones
+        rol = datos.get("rol", None if isinstance(habitaciones_usuario, dict) else "member")
+        registrar_usuario(datos["id"], rol, habitaciones_usuario)
+        for habitacion in USUARIOS[int(datos["id"])]["habitaciones"]:
+            if habitacion not in HABITACIONES:
+                # Típicamente, una habitación repetida entre bridges que lleva el sufijo "(bridge)"
+                logging.warning(f"La habitación {habitacion} del usuario {datos['id']} no existe")
+    avisar_sin_usuarios()
+    logging.info(f"Configuración cargada: {len(PUENTES)} bridges, {len(HABITACIONES)} habitaciones")
+
+# ─────────────────────────────────────────────────────────────
+# Control de acceso
+# ─────────────────────────────────────────────────────────────
+
+ROLES = ("readonly", "member", "admin")  # De menos a más permisos
+
+def registrar_usuario(user_id, rol="member", habitaciones_usuario=None):
+    # `rol` vale en todas las habitaciones salvo las de `habitaciones_usuario` ({habitación: rol}).
+    # Con una lista de habitaciones (formato anterior), `rol` solo vale en esas y el resto se deniega.
+    if isinstance(habitaciones_usuario, (list, tuple, set)):
+        habitaciones_usuario, rol = {h: rol for h in habitaciones_usuario}, None
+    habitaciones_usuario = dict(habitaciones_usuario or {})
+    if rol is not None and rol not in ROLES:
+        raise ValueError(f"Rol desconocido para {user_id}: {rol}")
+    for habitacion, rol_habitacion in habitaciones_usuario.items():
+        # "admin" da acceso a /stats y a todo el bot: no tiene sentido por habitación
+        if rol_habitacion not in ROLES or rol_habitacion == "admin":
+            raise ValueError(f"Rol no válido para {user_id} en {habitacion}: {rol_habitacion}")
+    USUARIOS[int(user_id)] = {"rol": rol, "habitaciones": habitaciones_usuario}
+
+def avisar_sin_usuarios():
+    if not USUARIOS:
+        logging.warning("No hay usuarios autorizados: el bot rechazará a todos (ver ADMINISTRADORES o [[usuarios]])")
+
+def rol_en(user_id, habitacion=None):
+    # Rol del usuario en `habitacion`; sin habitación, el mayor que tenga en cualquiera
+    usuario = USUARIOS.get(user_id)
+    if usuario is None:
+        return None
+    if habitacion is None:
+        roles = [r for r in (usuario["rol"], *usuario["habitaciones"].values()) if r is not None]
+        return max(roles, key=ROLES.index, default=None)
+    if usuario["rol"] == "admin":
+        return "admin"
+    return usuario["habitaciones"].get(habitacion, usuario["rol"])
+
+def permiso(user_id, habitacion=None, rol="member"):
+    actual = rol_en(user_id, habitacion)
+    return actual is not None and ROLES.index(actual) >= ROLES.index(rol)
+
+def habitaciones_visibles(user_id):
+    # Las que puede ver el usuario: el panel principal que abre, /report y /timers muestran solo estas
+    return tuple(h for h in HABITACIONES if permiso(user_id, h, "readonly"))
+
+def motivo_denegacion(user_id, data):
+    # Texto con el que se responde a un botón no permitido, o None si se permite
+    if user_id not in USUARIOS:
+        return "🔒 No tienes acceso a este bot"
+    if data in ("volver", "cerrar_panel") or data.startswith("page:"):
+        return None
+    if data == "apagar_todo":
+        return None if all(permiso(user_id, h) for h in HABITACIONES) else "🔒 Solo puedes controlar algunas habitaciones"
+    accion, habitacion = data.split(":", 1)[0], data.rsplit(":", 1)[-1]
+    if not permiso(user_id, habitacion, "readonly"):
+        return f"🔒 Sin acceso a {habitacion}"
+    if accion in ("room", "backroom", "color"):
+        return None
+    return None if permiso(user_id, habitacion) else f"🔒 Solo lectura en {habitacion}"
+
+def requiere_rol(rol):
+    # Decorador para handlers de comandos: responde con el id del usuario si no tiene permiso,
+    # para que un administrador pueda añadirlo.
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def envoltorio(update, context):
+            usuario = update.effective_user
+            if usuario is None or not permiso(usuario.id, rol=rol):
+                logging.warning(f"Acceso denegado a {getattr(usuario, 'id', None)} en {funcion.__name__}")
+                if update.effective_message is not None:
+                    await update.effective_message.reply_text(
+                        f"🔒 No tienes permiso para esto (tu id es {getattr(usuario, 'id', '?')})"
+                    )
+                return
+            return await funcion(update, context)
+        return envoltorio
+    return decorador
+
+# ─────────────────────────────────────────────────────────────
+# Grupos del bridge: una escritura por habitación
+# ─────────────────────────────────────────────────────────────
+
+async def preparar_grupos(app=None):
+    await asyncio.gather(*(preparar_grupos_puente(puente) for puente in PUENTES.values()))
+
+async def preparar_grupos_puente(puente):
+    # Asocia cada habitación a un grupo del bridge con exactamente sus luces,
+    # creando un LightGroup si no existe ninguno.
+    url = puente.url("groups")
+    grupos = await safe_get(url)
+    if not isinstance(grupos, dict):
+        logging.error(f"No se pudieron leer los grupos de {puente.nombre}, se escribirá luz a luz")
+        return
+    for hab in HABITACIONES.values():
+        if hab.puente is not puente:
+            continue
+        objetivo = sorted(str(luz_id) for luz_id in hab.luces)
+        candidatos = [gid for gid, grupo in grupos.items() if sorted(grupo.get("lights", [])) == objetivo]
+        # Si hay varios grupos con las mismas luces se prefiere el que se llama como la habitación
+        candidatos.sort(key=lambda gid: grupos[gid].get("name") != hab.nombre)
+        if candidatos:
+            hab.grupo_id = candidatos[0]
+            continue
+        response = await safe_post(url, {"name": hab.nombre[:32], "type": "LightGroup", "lights": objetivo})
+        try:
+            hab.grupo_id = response[0]["success"]["id"]
+            logging.info(f"Creado el grupo {hab.grupo_id} para {hab.nombre}")
+        except (TypeError, KeyError, IndexError):
+            logging.error(f"No se pudo crear el grupo para {hab.nombre}: {response}")
+
+def enviar_a_habitacion(habitacion, data):
+    # La acción de grupo la reparte el bridge, que ignora lo que cada luz no admite
+    hab = HABITACIONES[habitacion]
+    if hab.grupo_id is not None:
+        return hab.puente.programador.enviar(hab.puente.url(f"groups/{hab.grupo_id}/action"), data)
+    return asyncio.gather(*(enviar_a_luz(hab.puente, luz_id, data) for luz_id in hab.luces))
+
+def enviar_a_luces_con(habitacion, capacidad, data):
+    # Como enviar_a_habitacion, pero sin tocar las luces que no tienen `capacidad`: un
+    # {"on": True} de grupo encendería también, p. ej., las bombillas solo regulables.
+    hab = HABITACIONES[habitacion]
+    luces = hab.luces_con(capacidad)
+    if len(luces) == len(hab.luces):
+        return enviar_a_habitacion(habitacion, data)
+    return asyncio.gather(*(enviar_a_luz(hab.puente, luz_id, data) for luz_id in luces))
+
+def rampa_habitacion(habitacion, porcentaje, segundos):
+    # Lleva la habitación al brillo pedido en `segundos`: el bridge interpola el fundido.
+    # transitiontime va en décimas de segundo y no admite más de 65535 (unas 1,8 h);
+    # se acota antes de convertir, porque int() falla con valores enormes o infinitos.
+    transicion = int(min(max(segundos, 0), 6553.5) * 10)
+    if porcentaje <= 0:
+        cambio = {"on": False, "transitiontime": transicion}
+    else:
+        cambio = {"on": True, "bri": max(1, int(min(porcentaje, 100) * 254 / 100)), "transitiontime": transicion}
+    parches = parches_habitacion(habitacion, {k: v for k, v in cambio.items() if k != "transitiontime"})
+    return parches, [enviar_a_habitacion(habitacion, cambio)]
+
+def enviar_a_todas(data):
+    # El grupo 0 de cada bridge contiene siempre todas sus luces
+    return asyncio.gather(*(
+        puente.programador.enviar(puente.url("groups/0/action"), data)
+        for puente in PUENTES.values()
+    ))
+
+# ─────────────────────────────────────────────────────────────
+# Escenas: el estado de una habitación guardado y recuperado de una vez
+# ─────────────────────────────────────────────────────────────
+
+ESCENAS_MAX_NOMBRE = 32  # Límite de nombre de escena del bridge (y del botón)
+ESCENAS_POR_PANEL = 6    # Botones de escena que caben en el panel de una habitación
+
+def capturar_escena(snapshot, habitacion):
+    # Estado de cada luz, solo con los atributos que el bridge necesita para reproducirlo
+    estados = {}
+    for luz_id, estado in luces_en_snapshot(snapshot, habitacion):
+        if not estado["on"]:
+            estados[str(luz_id)] = {"on": False}
+            continue
+        captura = {"on": True}
+        if "bri" in estado:
+            captura["bri"] = estado["bri"]
+        modo = estado.get("colormode")
+        if modo == "xy" and "xy" in estado:
+            captura["xy"] = estado["xy"]
+        elif modo == "hs" and "hue" in estado:
+            captura.update(hue=estado["hue"], sat=estado.get("sat", 0))
+        elif "ct" in estado:
+            captura["ct"] = estado["ct"]
+        estados[str(luz_id)] = captura
+    return estados
+
+def cargar_escenas():
+    ESCENAS.clear()
+    for id_local, habitacion, nombre, escena_id, estados in db().execute(
+        "SELECT id, habitacion, nombre, escena_id, estados FROM escenas ORDER BY id"
+    ):
+        ESCENAS.setdefault(habitacion, {})[nombre] = {
+            "id": id_local, "escena_id": escena_id, "estados": json.loads(estados)
+        }
+
+async def guardar_escena(habitacion, nombre, snapshot):
+    # Se guarda en el bridge para recuperarla con una sola llamada al grupo; la copia
+    # local sirve para pintarla al instante y para bridges donde no se pudo crear.
+    hab = HABITACIONES[habitacion]
+    estados = capturar_escena(snapshot, habitacion)
+    if not estados:
+        return None
+    anterior = ESCENAS.get(habitacion, {}).get(nombre)
+    if anterior and anterior["escena_id"]:
+        await safe_delete(hab.puente.url(f"scenes/{anterior['escena_id']}"))
+    response = await safe_post(hab.puente.url("scenes"), {
+        "name": nombre,
+        "type": "LightScene",
+        "lights": list(estados),
+        "recycle": False,
+        "lightstates": estados
+    })
+    try:
+        escena_id = response[0]["success"]["id"]
+    except (TypeError, KeyError, IndexError):
+        logging.error(f"No se pudo crear la escena {nombre} en el bridge, se guarda solo en local: {response}")
+        escena_id = None
+    with db() as conexion:
+        conexion.execute("DELETE FROM escenas WHERE habitacion = ? AND nombre = ?", (habitacion, nombre))
+        cursor = conexion.execute(
+            "INSERT INTO escenas (habitacion, nombre, escena_id, estados) VALUES (?, ?, ?, ?)",
+            (habitacion, nombre, escena_id, json.dumps(estados))
+        )
+    escena = {"id": cursor.lastrowid, "escena_id": escena_id, "estados": estados}
+    ESCENAS.setdefault(habitacion, {})[nombre] = escena
+    return escena
+
+async def borrar_escena(habitacion, nombre):
+    escena = ESCENAS.get(habitacion, {}).pop(nombre, None)
+    if escena is None:
+        return False
+    if escena["escena_id"]:
+        await safe_delete(HABITACIONES[habitacion].puente.url(f"scenes/{escena['escena_id']}"))
+    with db() as conexion:
+        conexion.execute("DELETE FROM escenas WHERE id = ?", (escena["id"],))
+    return True
+
+def escena_por_id(habitacion, id_local):
+    for nombre, escena in ESCENAS.get(habitacion, {}).items():
+        if escena["id"] == id_local:
+            return nombre, escena
+    return None, None
+
+def recuperar_escena(habitacion, escena):
+    # Devuelve (parches, escrituras): una llamada al grupo si el bridge tiene la escena
+    hab = HABITACIONES[habitacion]
+    parches = {
+        (hab.puente.nombre, int(luz_id)): filtrar_parche(hab.puente, luz_id, estado)
+        for luz_id, estado in escena["estados"].items()
+    }
+    if hab.grupo_id is not None and escena["escena_id"]:
+        url = hab.puente.url(f"groups/{hab.grupo_id}/action")
+        return parches, [hab.puente.programador.enviar(url, {"scene": escena["escena_id"]})]
+    escrituras = [enviar_a_luz(hab.puente, luz_id, estado) for luz_id, estado in escena["estados"].items()]
+    return parches, escrituras
+
 # ─────────────────────────────────────────────────────────────
 # Funciones para generar los paneles de control
 # ─────────────────────────────────────────────────────────────
 
-async def generar_panel_principal():
+def fila_panel_principal(snapshot, habitacion):
+    estado = estado_habitacion(snapshot, habitacion)
+    brillo = brillo_habitacion(snapshot, habitacion)
+    return [InlineKeyboardButton(f"{estado} {habitacion} ({brillo}%)", callback_data=f"room:{habitacion}")]
+
+def total_paginas(habitaciones=None):
+    # `habitaciones`: las que se muestran en el menú principal (por defecto, todas)
+    habitaciones = HABITACIONES if habitaciones is None else habitaciones
+    return max(1, -(-len(habitaciones) // PANEL_TAMANO_PAGINA))
+
+def habitaciones_de_pagina(pagina, habitaciones=None):
+    habitaciones = HABITACIONES if habitaciones is None else habitaciones
+    inicio = pagina * PANEL_TAMANO_PAGINA
+    return list(habitaciones)[inicio:inicio + PANEL_TAMANO_PAGINA]
+
+@medir_render("main")
+async def generar_panel_principal(snapshot=None, filas=None, pagina=0, habitaciones=None):
+    # `filas` guarda por habitación (huella, fila) de un render anterior:
+    # solo se reconstruyen las filas cuya huella ha cambiado.
+    paginas = total_paginas(habitaciones)
+    pagina = min(max(pagina, 0), paginas - 1)
+    visibles = habitaciones_de_pagina(pagina, habitaciones)
+    if snapshot is None:
+        # Solo se consultan los bridges de las habitaciones de esta página
+        snapshot = await obtener_snapshot_luces(visibles)
+    if filas is None:
+        filas = {}
     keyboard = []
-    for habitacion in habitaciones.keys():
-        estado = await obtener_estado_habitacion(habitacion)
-        brillo = await obtener_brillo_habitacion(habitacion)
-        keyboard.append([InlineKeyboardButton(f"{estado} {habitacion} ({brillo}%)", callback_data=f"room:{habitacion}")])
+    for habitacion in visibles:
+        huella = huella_habitacion(snapshot, habitacion)
+        previa = filas.get(habitacion)
+        if previa is None or previa[0] != huella:
+            previa = filas[habitacion] = (huella, fila_panel_principal(snapshot, habitacion))
+        keyboard.append(previa[1])
+    if paginas > 1:
+        navegacion = []
+        if pagina > 0:
+            navegacion.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"page:{pagina - 1}"))
+        if pagina < paginas - 1:
+            navegacion.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"page:{pagina + 1}"))
+        keyboard.append(navegacion)
     keyboard.append([InlineKeyboardButton("🛑 Apagar Todo", callback_data="apagar_todo")])
     # Botón para cerrar panel y poner el bot en reposo
     keyboard.append([InlineKeyboardButton("❌ Cerrar panel", callback_data="cerrar_panel")])
     markup = InlineKeyboardMarkup(keyboard)
     texto = "💡 **Control de Luces Philips Hue**\n\nSelecciona una habitación:"
+    if paginas > 1:
+        texto += f" (página {pagina + 1}/{paginas})"
     return texto, markup
 
-async def generar_panel_habitacion(habitacion):
-    estado = await obtener_estado_habitacion(habitacion)
-    brillo = await obtener_brillo_habitacion(habitacion)
-    texto = f"💡 **Controles para {habitacion}**\n\nEstado: {estado}\nBrillo: {brillo}%"
-    keyboard = [
-        [InlineKeyboardButton("🔌 Encender/Apagar", callback_data=f"toggle:{habitacion}")],
-        [InlineKeyboardButton("🔆 Brillo +", callback_data=f"bright_inc:{habitacion}"),
-         InlineKeyboardButton("🔅 Brillo -", callback_data=f"bright_dec:{habitacion}")],
-        [InlineKeyboardButton("📉 Brillo 25%", callback_data=f"bright_set:25:{habitacion}"),
-         InlineKeyboardButton("📊 Brillo 50%", callback_data=f"bright_set:50:{habitacion}"),
-         InlineKeyboardButton("📈 Brillo 100%", callback_data=f"bright_set:100:{habitacion}")],
-        [InlineKeyboardButton("🎨 Tono de Color", callback_data=f"color:{habitacion}")],
+@medir_render("room")
+async def generar_panel_habitacion(habitacion, snapshot=None):
+    if snapshot is None:
+        snapshot = await obtener_snapshot_luces([habitacion])
+    estado = estado_habitacion(snapshot, habitacion)
+    brillo = brillo_habitacion(snapshot, habitacion)
+    capacidades = HABITACIONES[habitacion].capacidades
+    texto = f"💡 **Controles para {escape_markdown(habitacion)}**\n\nEstado: {estado}\nBrillo: {brillo}%"
+    keyboard = [[InlineKeyboardButton("🔌 Encender/Apagar", callback_data=f"toggle:{habitacion}")]]
+    # Solo se muestran los controles que admite alguna luz de la habitación
+    if "brillo" in capacidades:
+        keyboard += [
+            [InlineKeyboardButton("🔆 Brillo +", callback_data=f"bright_inc:{habitacion}"),
+             InlineKeyboardButton("🔅 Brillo -", callback_data=f"bright_dec:{habitacion}")],
+            [InlineKeyboardButton("📉 Brillo 25%", callback_data=f"bright_set:25:{habitacion}"),
+             InlineKeyboardButton("📊 Brillo 50%", callback_data=f"bright_set:50:{habitacion}"),
+             InlineKeyboardButton("📈 Brillo 100%", callback_data=f"bright_set:100:{habitacion}")]
+        ]
+    if capacidades & {"color", "ct"}:
+        keyboard.append([InlineKeyboardButton("🎨 Tono de Color", callback_data=f"color:{habitacion}")])
+    # Escenas guardadas con /scene save: un toque las aplica
+    botones_escena = [
+        InlineKeyboardButton(f"🎬 {nombre}", callback_data=f"escena:{escena['id']}:{habitacion}")
+        for nombre, escena in list(ESCENAS.get(habitacion, {}).items())[:ESCENAS_POR_PANEL]
+    ]
+    for i in range(0, len(botones_escena), 2):
+        keyboard.append(botones_escena[i:i + 2])
+    keyboard += [
         [InlineKeyboardButton("⬅ Volver", callback_data="volver")],
         # Botón para cerrar panel
         [InlineKeyboardButton("❌ Cerrar panel", callback_data="cerrar_panel")]
@@ -127,9 +1097,10 @@ async def generar_panel_habitacion(habitacion):
     markup = InlineKeyboardMarkup(keyboard)
     return texto, markup
 
-async def generar_panel_color(habitacion):
-    if habitacion in ["Terraza", "Comedor"]:
-        texto = f"🎨 **Selecciona el tono de color para {habitacion}**"
+@medir_render("color")
+async def generar_panel_color(habitacion, snapshot=None):
+    if "color" in HABITACIONES[habitacion].capacidades:
+        texto = f"🎨 **Selecciona el tono de color para {escape_markdown(habitacion)}**"
         colores = [
             ("🟥 Rojo", 0, 254),
             ("🟩 Verde", 25500, 254),
@@ -144,11 +1115,13 @@ async def generar_panel_color(habitacion):
         keyboard.append([InlineKeyboardButton("⬅ Volver", callback_data=f"backroom:{habitacion}")])
         # Botón para cerrar panel
         keyboard.append([InlineKeyboardButton("❌ Cerrar panel", callback_data="cerrar_panel")])
-    else:
-        current_ct = await obtener_ct_habitacion(habitacion)
+    elif "ct" in HABITACIONES[habitacion].capacidades:
+        if snapshot is None:
+            snapshot = await obtener_snapshot_luces([habitacion])
+        current_ct = ct_habitacion(snapshot, habitacion)
         if current_ct is None:
             current_ct = 300  # Valor por defecto
-        texto = f"🎨 **Modifica la tonalidad para {habitacion}**\nTemperatura actual: {current_ct}"
+        texto = f"🎨 **Modifica la tonalidad para {escape_markdown(habitacion)}**\nTemperatura actual: {current_ct}"
         keyboard = [
             [InlineKeyboardButton("➕ Más Amarillo", callback_data=f"ct_inc:{habitacion}")],
             [InlineKeyboardButton("➖ Más Blanco", callback_data=f"ct_dec:{habitacion}")],
@@ -156,72 +1129,785 @@ async def generar_panel_color(habitacion):
         ]
         # Botón para cerrar panel
         keyboard.append([InlineKeyboardButton("❌ Cerrar panel", callback_data="cerrar_panel")])
+    else:
+        texto = f"🎨 **Las luces de {escape_markdown(habitacion)} no admiten cambios de tono**"
+        keyboard = [
+            [InlineKeyboardButton("⬅ Volver", callback_data=f"backroom:{habitacion}")],
+            [InlineKeyboardButton("❌ Cerrar panel", callback_data="cerrar_panel")]
+        ]
     markup = InlineKeyboardMarkup(keyboard)
     return texto, markup
 
+# ─────────────────────────────────────────────────────────────
+# Cola de ediciones de Telegram
+# ─────────────────────────────────────────────────────────────
+
+class ColaEdiciones:
+    # Una sola edición pendiente por mensaje: si llega otra antes de enviarla,
+    # la anterior se descarta. Respeta un ritmo por chat, otro global y los
+    # RetryAfter que devuelva Telegram.
+
+    def __init__(self, cubo, intervalo_chat):
+        self.cubo = cubo
+        self.intervalo_chat = intervalo_chat
+        self._pendientes = {}    # (chat_id, message_id) -> [bot, texto, markup, futuro]
+        self._proximo_chat = {}  # chat_id -> instante a partir del cual se puede editar
+        self._en_vuelo = set()   # chats con una edición enviándose ahora mismo
+        self._hay_trabajo = asyncio.Event()
+        self._tarea = None
+
+    def editar(self, bot, chat_id, message_id, texto, markup):
+        # El futuro devuelve True si la edición llegó a Telegram (o no hacía falta)
+        futuro = asyncio.get_running_loop().create_future()
+        anterior = self._pendientes.pop((chat_id, message_id), None)
+        if anterior and not anterior[3].done():
+            anterior[3].set_result(False)
+        self._pendientes[(chat_id, message_id)] = [bot, texto, markup, futuro]
+        self._avisar()
+        return futuro
+
+    def _avisar(self):
+        self._hay_trabajo.set()
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._procesar())
+
+    async def _procesar(self):
+        # Solo marca el ritmo: cada edición sale en su propia tarea para que la
+        # latencia de Telegram no limite el total, con una en vuelo por chat como mucho.
+        while self._pendientes:
+            ahora = time.monotonic()
+            esperando = [clave for clave in self._pendientes if clave[0] not in self._en_vuelo]
+            listos = [clave for clave in esperando if self._proximo_chat.get(clave[0], 0) <= ahora]
+            if not listos:
+                # Sin nada listo se espera al próximo chat desbloqueado o a que acabe una edición
+                espera = min((self._proximo_chat[clave[0]] for clave in esperando), default=None)
+                self._hay_trabajo.clear()
+                try:
+                    await asyncio.wait_for(self._hay_trabajo.wait(),
+                                           timeout=None if espera is None else espera - ahora)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.cubo.tomar()
+            clave = listos[0]
+            entrada = self._pendientes.pop(clave, None)
+            if entrada is None or clave[0] in self._en_vuelo:
+                if entrada is not None:
+                    self._pendientes[clave] = entrada
+                continue
+            self._en_vuelo.add(clave[0])
+            self._proximo_chat[clave[0]] = time.monotonic() + self.intervalo_chat
+            asyncio.create_task(self._enviar(clave, entrada))
+        # Los chats sin bloqueo vigente no necesitan seguir ocupando memoria
+        ahora = time.monotonic()
+        self._proximo_chat = {c: t for c, t in self._proximo_chat.items() if t > ahora or c in self._en_vuelo}
+
+    async def _enviar(self, clave, entrada):
+        chat_id, message_id = clave
+        bot, texto, markup, futuro = entrada
+        enviado = False
+        inicio = time.monotonic()
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=texto,
+                reply_markup=markup,
+                parse_mode="Markdown"
+            )
+            enviado = True
+            TELEGRAM_EDICION.observar(time.monotonic() - inicio)
+        except RetryAfter as e:
+            TELEGRAM_RETRY_AFTER.inc()
+            espera = e.retry_after
+            if hasattr(espera, "total_seconds"):
+                espera = espera.total_seconds()
+            logging.warning(f"Telegram pide esperar {espera}s antes de editar en {chat_id}")
+            self._proximo_chat[chat_id] = time.monotonic() + espera
+            # Se reintenta salvo que mientras tanto haya llegado una edición más nueva
+            if clave not in self._pendientes:
+                self._pendientes[clave] = entrada
+                return
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                TELEGRAM_NO_MODIFICADO.inc()
+                enviado = True
+            elif "Message to edit not found" not in str(e):
+                logging.error(f"Error editando mensaje: {e}")
+        except Exception as e:
+            logging.error(f"Error editando mensaje: {e}")
+        finally:
+            self._en_vuelo.discard(chat_id)
+            self._avisar()
+        if not futuro.done():
+            futuro.set_result(enviado)
+
+COLA_EDICIONES = ColaEdiciones(
+    CuboTokens(TELEGRAM_EDICIONES_POR_SEGUNDO, TELEGRAM_EDICIONES_POR_SEGUNDO),
+    TELEGRAM_INTERVALO_CHAT
+)
+
 async def actualizar_mensaje(context, chat_id, message_id, texto, markup):
-    try:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=texto,
-            reply_markup=markup,
-            parse_mode="Markdown"
-        )
-    except BadRequest as e:
-        error_message = str(e)
-        if "Message is not modified" in error_message or "Message to edit not found" in error_message:
-            return
-        else:
-            raise
+    return await COLA_EDICIONES.editar(context.bot, chat_id, message_id, texto, markup)
 
 # ─────────────────────────────────────────────────────────────
 # Actualización periódica del panel
 # ─────────────────────────────────────────────────────────────
 
-async def actualizar_panel_periodicamente(context: CallbackContext):
-    job_data = context.job.data
-    chat_id = job_data["chat_id"]
-    message_id = job_data["message_id"]
+async def generar_panel(panel_actual, snapshot, filas=None, habitaciones=None):
+    if panel_actual.startswith("room:"):
+        return await generar_panel_habitacion(panel_actual.split("room:")[1], snapshot)
+    if panel_actual.startswith("color:"):
+        return await generar_panel_color(panel_actual.split("color:")[1], snapshot)
+    return await generar_panel_principal(snapshot, filas, pagina_de_panel(panel_actual), habitaciones)
+
+async def mostrar_panel(context, chat_id, message_id, panel_actual, snapshot, texto=None):
+    # Pinta el panel a partir de `snapshot` y recuerda sus huellas, de modo que el
+    # refresco posterior solo vuelve a editar si el bridge muestra algo distinto.
+    PANEL_STATES[chat_id] = panel_actual
+    visibles = habitaciones_de_chat(chat_id)
+    filas = {}
+    texto_panel, markup = await generar_panel(panel_actual, snapshot, filas, visibles)
+    huellas = {h: huella_habitacion(snapshot, h, panel_actual) for h in habitaciones_de_panel(panel_actual, visibles)}
+    if await actualizar_mensaje(context, chat_id, message_id, texto or texto_panel, markup):
+        PANEL_LAST_STATE[chat_id] = {"panel": panel_actual, "huellas": huellas, "filas": filas}
+        marcar_panel(chat_id)
+
+async def navegar(context, chat_id, message_id, panel_actual):
+    # Cambio de panel: se pinta con mostrar_panel para que sus huellas queden registradas
+    snapshot = await obtener_snapshot_luces(habitaciones_de_panel(panel_actual, habitaciones_de_chat(chat_id)))
+    await mostrar_panel(context, chat_id, message_id, panel_actual, snapshot)
+
+async def reconciliar_panel(bot, chat_id, escrituras):
+    # Cuando el bridge ha recibido las escrituras se relee y se corrige el panel si hace falta
+    await asyncio.gather(*escrituras)
+    await refrescar_panel(bot, chat_id)
+
+async def aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras, panel_actual, texto):
+    # UI optimista: se pinta el estado pedido sin esperar al bridge
+    visibles = habitaciones_de_panel(panel_actual, habitaciones_de_chat(chat_id))
+    snapshot = snapshot_con_parches(await obtener_snapshot_luces(visibles), parches)
+    for puente, parches_puente in parches_por_puente(parches).items():
+        PUENTES[puente].cache.aplicar_optimista(parches_puente)
+    await mostrar_panel(context, chat_id, message_id, panel_actual, snapshot, texto)
+    context.application.create_task(reconciliar_panel(context.bot, chat_id, escrituras))
+
+def pagina_de_panel(panel_actual):
+    # "main" (paneles anteriores a la paginación) equivale a "main:0"
+    if panel_actual.startswith("main:"):
+        try:
+            return int(panel_actual.split(":", 1)[1])
+        except ValueError:
+            return 0
+    return 0
+
+def pagina_de_chat(chat_id):
+    # Página del menú principal del chat, deducida del panel guardado para que sobreviva
+    # a un reinicio: desde una habitación se vuelve a la página que la contiene
+    panel_actual = PANEL_STATES.get(chat_id, "")
+    if panel_actual.startswith("room:") or panel_actual.startswith("color:"):
+        habitacion = panel_actual.split(":", 1)[1]
+        visibles = habitaciones_de_chat(chat_id)
+        visibles = list(HABITACIONES if visibles is None else visibles)
+        return visibles.index(habitacion) // PANEL_TAMANO_PAGINA if habitacion in visibles else 0
+    return pagina_de_panel(panel_actual)
+
+def habitaciones_de_panel(panel_actual, habitaciones=None):
+    if panel_actual.startswith("room:") or panel_actual.startswith("color:"):
+        return [panel_actual.split(":", 1)[1]]
+    return habitaciones_de_pagina(pagina_de_panel(panel_actual), habitaciones)
+
+def habitaciones_de_chat(chat_id):
+    # Habitaciones del menú principal de este chat (None: todas, p. ej. paneles sin dueño conocido)
+    usuario = PANEL_USUARIOS.get(chat_id)
+    return None if usuario is None else habitaciones_visibles(usuario)
+
+def vista_de_chat(chat_id):
+    # Dos chats comparten vista si muestran el mismo panel con las mismas habitaciones
+    panel_actual = PANEL_STATES.get(chat_id, "")
+    if panel_actual.startswith("room:") or panel_actual.startswith("color:"):
+        return panel_actual, None
+    return panel_actual, habitaciones_de_chat(chat_id)
 
-    # Si el panel ya fue cerrado, no se actualiza
-    if chat_id not in PANEL_STATES:
+async def refrescar_vistas(context: CallbackContext):
+    # Un único job para todos los paneles: cada vista distinta se calcula una vez
+    guardar_paneles()
+    vistas = {chat_id: vista_de_chat(chat_id) for chat_id in list(PANEL_STATES)}
+    for vista in list(VISTAS):
+        if vista not in vistas.values():
+            del VISTAS[vista]
+    chats = [
+        chat_id for chat_id, vista in vistas.items()
+        # Si todos los bridges del panel tienen el eventstream conectado, los cambios llegan solos
+        if not all(HABITACIONES[h].puente.cache.espejo_activo
+                   for h in habitaciones_de_panel(*vista) if h in HABITACIONES)
+    ]
+    await refrescar_chats(context.bot, chats)
+
+async def refrescar_panel(bot, chat_id):
+    await refrescar_chats(bot, [chat_id])
+
+async def refrescar_chats(bot, chat_ids):
+    # Agrupa los chats por el panel que muestran y refresca cada vista una sola vez
+    por_vista = {}
+    for chat_id in chat_ids:
+        # Si el panel ya fue cerrado, no se actualiza
+        if chat_id in PANEL_STATES and chat_id in PANEL_MENSAJES:
+            por_vista.setdefault(vista_de_chat(chat_id), []).append(chat_id)
+    await asyncio.gather(*(refrescar_vista(bot, vista, chats) for vista, chats in por_vista.items()))
+
+async def refrescar_vista(bot, vista, chats):
+    panel_actual, visibles = vista
+    snapshot = await obtener_snapshot_luces(habitaciones_de_panel(panel_actual, visibles))
+    huellas = {h: huella_habitacion(snapshot, h, panel_actual) for h in habitaciones_de_panel(panel_actual, visibles)}
+
+    pendientes = []
+    for chat_id in chats:
+        last_state = PANEL_LAST_STATE.get(chat_id, {})
+        if last_state.get("panel") == panel_actual and last_state.get("huellas") == huellas:
+            # Nada visible ha cambiado: ni se construye el teclado ni se edita el mensaje
+            PANEL_OMITIDO.inc()
+        else:
+            pendientes.append(chat_id)
+    if not pendientes:
         return
 
-    panel_actual = PANEL_STATES.get(chat_id, "main")
-    if panel_actual == "main":
-        new_text, new_markup = await generar_panel_principal()
-    elif panel_actual.startswith("room:"):
-        habitacion = panel_actual.split("room:")[1]
-        new_text, new_markup = await generar_panel_habitacion(habitacion)
-    elif panel_actual.startswith("color:"):
-        habitacion = panel_actual.split("color:")[1]
-        new_text, new_markup = await generar_panel_color(habitacion)
-    else:
-        new_text, new_markup = await generar_panel_principal()
+    # Las filas se reutilizan entre refrescos y entre todos los chats con esta vista
+    filas = VISTAS.setdefault(vista, {})
+    new_text, new_markup = await generar_panel(panel_actual, snapshot, filas, visibles)
+
+    # No se espera a Telegram: un chat frenado por RetryAfter no puede retener el
+    # job compartido, así que cada edición anota su estado al completarse.
+    nuevo_estado = {"panel": panel_actual, "huellas": huellas, "filas": filas}
+    for chat_id in pendientes:
+        futuro = COLA_EDICIONES.editar(bot, chat_id, PANEL_MENSAJES[chat_id], new_text, new_markup)
+        futuro.add_done_callback(functools.partial(anotar_edicion, chat_id, nuevo_estado))
+
+def anotar_edicion(chat_id, nuevo_estado, futuro):
+    if not futuro.cancelled() and futuro.result():
+        PANEL_LAST_STATE[chat_id] = nuevo_estado
+        marcar_panel(chat_id)
 
-    last_state = PANEL_LAST_STATE.get(chat_id, {})
-    last_text = last_state.get("text")
-    last_markup = last_state.get("markup")
+# ─────────────────────────────────────────────────────────────
+# Eventos en tiempo real del bridge (Hue API v2, SSE)
+# ─────────────────────────────────────────────────────────────
+
+def cambios_desde_evento(recurso):
+    # Traduce un recurso "light" de la API v2 al formato de estado de la API v1
+    cambios = {}
+    if "on" in recurso:
+        cambios["on"] = recurso["on"]["on"]
+    if "dimming" in recurso:
+        cambios["bri"] = max(1, round(recurso["dimming"]["brightness"] * 254 / 100))
+    mirek = recurso.get("color_temperature", {}).get("mirek")
+    if mirek is not None:
+        cambios["ct"] = mirek
+    return cambios
+
+def procesar_eventos_hue(puente, eventos):
+    # Aplica un bloque de eventos al espejo local y devuelve las habitaciones afectadas
+    afectadas = set()
+    for evento in eventos:
+        if evento.get("type") != "update":
+            continue
+        for recurso in evento.get("data", []):
+            id_v1 = recurso.get("id_v1", "")
+            if recurso.get("type") != "light" or not id_v1.startswith("/lights/"):
+                continue
+            luz_id = int(id_v1.split("/")[-1])
+            cambios = cambios_desde_evento(recurso)
+            if not cambios:
+                continue
+            puente.cache.aplicar_cambios(luz_id, cambios)
+            afectadas.update(HABITACIONES_POR_LUZ.get((puente.nombre, luz_id), []))
+    return afectadas
+
+async def refrescar_paneles_afectados(bot, afectadas):
+    # Solo se repintan los paneles que muestran alguna habitación que ha cambiado
+    await refrescar_chats(bot, [
+        chat_id for chat_id in list(PANEL_STATES)
+        if afectadas.intersection(habitaciones_de_panel(*vista_de_chat(chat_id)))
+    ])
+
+AFECTADAS_PENDIENTES = set()  # Habitaciones cambiadas desde el último refresco en segundo plano
+REFRESCO_AFECTADAS = None
+
+def programar_refresco(app, afectadas):
+    # Quien aplica los cambios no espera a Telegram: los paneles se repintan en otra
+    # tarea y lo que cambie mientras tanto se acumula para la siguiente pasada.
+    global REFRESCO_AFECTADAS
+    AFECTADAS_PENDIENTES.update(afectadas)
+    if REFRESCO_AFECTADAS is None or REFRESCO_AFECTADAS.done():
+        REFRESCO_AFECTADAS = app.create_task(refrescar_pendientes(app.bot))
+
+async def refrescar_pendientes(bot):
+    while AFECTADAS_PENDIENTES:
+        afectadas = set(AFECTADAS_PENDIENTES)
+        AFECTADAS_PENDIENTES.clear()
+        await refrescar_paneles_afectados(bot, afectadas)
+
+async def escuchar_eventstream(app, puente):
+    url = puente.eventstream_url
+    cabeceras = {"hue-application-key": puente.usuario, "Accept": "text/event-stream"}
+    espera = 1
+    # El bridge usa un certificado autofirmado; el stream no cuenta en el pool normal
+    async with httpx.AsyncClient(verify=False, timeout=httpx.Timeout(HUE_HTTP_TIMEOUT, read=None)) as cliente:
+        while True:
+            try:
+                async with cliente.stream("GET", url, headers=cabeceras) as response:
+                    response.raise_for_status()
+                    puente.cache.espejo_activo = True
+                    # Lo ocurrido mientras estábamos desconectados no llegó como evento
+                    puente.cache.invalidar()
+                    espera = 1
+                    logging.info(f"Conectado al eventstream de {puente.nombre}")
+                    datos = []
+                    async for linea in response.aiter_lines():
+                        if linea.startswith("data:"):
+                            datos.append(linea[5:].strip())
+                        elif not linea and datos:
+                            try:
+                                afectadas = procesar_eventos_hue(puente, json.loads("".join(datos)))
+                            except (ValueError, KeyError, TypeError) as e:
+                                logging.error(f"Evento del bridge no válido: {e}")
+                                afectadas = set()
+                            datos = []
+                            if afectadas:
+                                programar_refresco(app, afectadas)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Eventstream de {puente.nombre} desconectado, se vuelve a sondear: {e}")
+            finally:
+                puente.cache.espejo_activo = False
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 60)
+
+# ─────────────────────────────────────────────────────────────
+# Persistencia de paneles entre reinicios
+# ─────────────────────────────────────────────────────────────
+
+DB = None
+
+def db():
+    global DB
+    if DB is None:
+        DB = sqlite3.connect(DB_PATH)
+        DB.execute("""
+            CREATE TABLE IF NOT EXISTS paneles (
+                chat_id INTEGER PRIMARY KEY,
+                message_id INTEGER NOT NULL,
+                panel TEXT NOT NULL,
+                expira_en REAL NOT NULL,
+                huellas TEXT,
+                usuario INTEGER
+            )
+        """)
+        columnas = [fila[1] for fila in DB.execute("PRAGMA table_info(paneles)")]
+        if "huellas" not in columnas:
+            # Bases creadas antes de guardar las huellas
+            DB.execute("ALTER TABLE paneles ADD COLUMN huellas TEXT")
+        if "usuario" not in columnas:
+            # Bases creadas antes de los permisos por habitación
+            DB.execute("ALTER TABLE paneles ADD COLUMN usuario INTEGER")
+        DB.execute("""
+            CREATE TABLE IF NOT EXISTS acciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                habitacion TEXT NOT NULL,
+                accion TEXT NOT NULL,
+                parametro REAL,
+                repeticion TEXT,
+                vence REAL NOT NULL
+            )
+        """)
+        DB.execute("""
+            CREATE TABLE IF NOT EXISTS consumo_horas (
+                habitacion TEXT NOT NULL,
+                hora INTEGER NOT NULL,
+                segundos REAL NOT NULL,
+                wh REAL NOT NULL,
+                PRIMARY KEY (habitacion, hora)
+            ) WITHOUT ROWID
+        """)
+        DB.execute("""
+            CREATE TABLE IF NOT EXISTS consumo_dias (
+                habitacion TEXT NOT NULL,
+                dia TEXT NOT NULL,
+                segundos REAL NOT NULL,
+                wh REAL NOT NULL,
+                PRIMARY KEY (habitacion, dia)
+            ) WITHOUT ROWID
+        """)
+        DB.execute("""
+            CREATE TABLE IF NOT EXISTS escenas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                habitacion TEXT NOT NULL,
+                nombre TEXT NOT NULL,
+                escena_id TEXT,
+                estados TEXT NOT NULL,
+                UNIQUE (habitacion, nombre)
+            )
+        """)
+        DB.commit()
+    return DB
+
+# Cada toque reprograma la expiración y cada refresco cambia las huellas: en vez de
+# escribir en SQLite en cada uno, los chats se marcan y se guardan juntos cada
+# PANEL_INTERVALO_REFRESCO segundos (y al parar el bot).
+PANEL_EXPIRA = {}       # chat_id -> instante de expiración del panel
+PANELES_SUCIOS = set()  # chats cuyo estado guardado está desactualizado
+
+def marcar_panel(chat_id):
+    PANELES_SUCIOS.add(chat_id)
+
+def guardar_paneles():
+    filas = []
+    for chat_id in PANELES_SUCIOS:
+        if chat_id not in PANEL_STATES or chat_id not in PANEL_MENSAJES or chat_id not in PANEL_EXPIRA:
+            continue
+        last_state = PANEL_LAST_STATE.get(chat_id, {})
+        # Las huellas solo valen si son del panel que se muestra ahora
+        huellas = last_state.get("huellas") if last_state.get("panel") == PANEL_STATES[chat_id] else None
+        filas.append((chat_id, PANEL_MENSAJES[chat_id], PANEL_STATES[chat_id], PANEL_EXPIRA[chat_id],
+                      None if huellas is None else json.dumps(huellas), PANEL_USUARIOS.get(chat_id)))
+    PANELES_SUCIOS.clear()
+    if filas:
+        with db() as conexion:
+            conexion.executemany(
+                "INSERT OR REPLACE INTO paneles (chat_id, message_id, panel, expira_en, huellas, usuario) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                filas
+            )
+
+def borrar_panel(chat_id):
+    PANELES_SUCIOS.discard(chat_id)
+    PANEL_EXPIRA.pop(chat_id, None)
+    with db() as conexion:
+        conexion.execute("DELETE FROM paneles WHERE chat_id = ?", (chat_id,))
+
+async def restaurar_paneles(app):
+    # Vuelve a armar los jobs de los paneles que seguían abiertos al parar el bot
+    filas = db().execute("SELECT chat_id, message_id, panel, expira_en, huellas, usuario FROM paneles").fetchall()
+    ahora = time.time()
+    for chat_id, message_id, panel, expira_en, huellas, usuario in filas:
+        if expira_en <= ahora:
+            # Caducó mientras el bot estaba parado: se elimina sin volver a pintarlo
+            try:
+                await app.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                logging.info(f"No se pudo eliminar el panel caducado de {chat_id}: {e}")
+            borrar_panel(chat_id)
+            continue
+        PANEL_STATES[chat_id] = panel
+        if usuario is not None:
+            PANEL_USUARIOS[chat_id] = usuario
+        if huellas:
+            # Con las huellas de lo que ya muestra el mensaje, el primer refresco solo
+            # edita si algo ha cambiado mientras el bot estaba parado
+            PANEL_LAST_STATE[chat_id] = {
+                "panel": panel,
+                "huellas": {h: tuple(huella) for h, huella in json.loads(huellas).items()},
+                "filas": {}
+            }
+        armar_jobs_panel(app, chat_id, message_id, expira_en - ahora)
+    if filas:
+        logging.info(f"Restaurados {len(PANEL_STATES)} paneles de {len(filas)} guardados")
+
+# ─────────────────────────────────────────────────────────────
+# Agenda de acciones: temporizadores, horarios diarios y despertadores
+# ─────────────────────────────────────────────────────────────
+
+def instante_sol(fecha, salida, latitud=None, longitud=None):
+    # Salida o puesta de sol (epoch) de `fecha` con la ecuación del amanecer (NOAA),
+    # sin conexión. Devuelve None si ese día el sol no sale o no se pone.
+    latitud = LATITUD if latitud is None else latitud
+    longitud = LONGITUD if longitud is None else longitud
+    n = fecha.toordinal() + 1721424.5 + 0.5 - 2451545.0
+    j_media = n - longitud / 360
+    m = math.radians((357.5291 + 0.98560028 * j_media) % 360)
+    c = 1.9148 * math.sin(m) + 0.02 * math.sin(2 * m) + 0.0003 * math.sin(3 * m)
+    eclip = math.radians((math.degrees(m) + c + 180 + 102.9372) % 360)
+    j_transito = 2451545.0 + j_media + 0.0053 * math.sin(m) - 0.0069 * math.sin(2 * eclip)
+    declinacion = math.asin(math.sin(eclip) * math.sin(math.radians(23.4397)))
+    phi = math.radians(latitud)
+    cos_omega = (math.sin(math.radians(-0.833)) - math.sin(phi) * math.sin(declinacion)) / (
+        math.cos(phi) * math.cos(declinacion)
+    )
+    if abs(cos_omega) > 1:
+        return None
+    omega = math.degrees(math.acos(cos_omega))
+    juliano = j_transito - omega / 360 if salida else j_transito + omega / 360
+    return (juliano - 2440587.5) * 86400
+
+HORA_VALIDA = r"([01]?\d|2[0-3]):[0-5]\d"  # HH:MM de 00:00 a 23:59
+
+def siguiente_vencimiento(repeticion, desde):
+    # `repeticion` es "HH:MM", "sunrise" o "sunset" con un desfase opcional en
+    # minutos ("sunset+30", "07:30-20"), en la hora local del equipo.
+    base, signo, desfase = re.fullmatch(r"([a-z]+|\d{1,2}:\d{2})(?:([+-])(\d+))?", repeticion).groups()
+    desfase = (int(desfase) * 60 if desfase else 0) * (-1 if signo == "-" else 1)
+    fecha = datetime.date.fromtimestamp(desde)
+    for dias in range(370):
+        dia = fecha + datetime.timedelta(days=dias)
+        if base in ("sunrise", "sunset"):
+            instante = instante_sol(dia, base == "sunrise")
+            if instante is None:
+                continue
+        else:
+            horas, minutos = map(int, base.split(":"))
+            instante = datetime.datetime.combine(dia, datetime.time(horas, minutos)).timestamp()
+        if instante + desfase > desde:
+            return instante + desfase
+    return None
+
+def cambio_accion(accion):
+    if accion["accion"] == "on":
+        return {"on": True}
+    if accion["accion"] == "off":
+        return {"on": False}
+    # "wake": desde apagada, on con transitiontime sube el brillo poco a poco
+    transicion = min(int((accion["parametro"] or 0) * 600), 65535)
+    return {"on": True, "bri": 254, "transitiontime": transicion}
+
+class AgendaAcciones:
+    # Un montículo ordenado por vencimiento y una sola tarea que duerme hasta el
+    # primero: miles de acciones pendientes no cuestan ni jobs ni timers. Las
+    # canceladas se quedan en el montículo y se descartan al llegar a la cima.
+
+    def __init__(self):
+        self.acciones = {}     # id -> acción (fila de la tabla `acciones`)
+        self._monticulo = []   # (vence, id)
+        self._despertar = asyncio.Event()
+        self.tarea = None
+
+    def cargar(self):
+        ahora = time.time()
+        filas = db().execute(
+            "SELECT id, chat_id, habitacion, accion, parametro, repeticion, vence FROM acciones"
+        ).fetchall()
+        for id_accion, chat_id, habitacion, accion, parametro, repeticion, vence in filas:
+            datos = {"id": id_accion, "chat_id": chat_id, "habitacion": habitacion, "accion": accion,
+                     "parametro": parametro, "repeticion": repeticion, "vence": vence}
+            if vence < ahora - AGENDA_GRACIA:
+                # Vencida hace demasiado con el bot parado: se salta esa ocurrencia
+                with db() as conexion:
+                    if not repeticion or not self._reprogramar(conexion, datos, ahora):
+                        self._olvidar(conexion, id_accion)
+                continue
+            self._meter(datos)
+        if filas:
+            logging.info(f"Agenda restaurada: {len(self.acciones)} acciones pendientes")
+
+    def _meter(self, datos):
+        self.acciones[datos["id"]] = datos
+        if not self._monticulo or datos["vence"] < self._monticulo[0][0]:
+            self._despertar.set()
+        heapq.heappush(self._monticulo, (datos["vence"], datos["id"]))
+
+    def programar(self, chat_id, habitacion, accion, vence, parametro=None, repeticion=None):
+        with db() as conexion:
+            cursor = conexion.execute(
+                "INSERT INTO acciones (chat_id, habitacion, accion, parametro, repeticion, vence) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, habitacion, accion, parametro, repeticion, vence)
+            )
+        datos = {"id": cursor.lastrowid, "chat_id": chat_id, "habitacion": habitacion, "accion": accion,
+                 "parametro": parametro, "repeticion": repeticion, "vence": vence}
+        self._meter(datos)
+        return datos
+
+    def cancelar(self, id_accion, chat_id):
+        datos = self.acciones.get(id_accion)
+        if datos is None or datos["chat_id"] != chat_id:
+            return False
+        with db() as conexion:
+            self._olvidar(conexion, id_accion)
+        return True
+
+    def _olvidar(self, conexion, id_accion):
+        self.acciones.pop(id_accion, None)
+        conexion.execute("DELETE FROM acciones WHERE id = ?", (id_accion,))
+
+    def _reprogramar(self, conexion, datos, desde):
+        vence = siguiente_vencimiento(datos["repeticion"], desde)
+        if vence is None:
+            return False
+        datos["vence"] = vence
+        conexion.execute("UPDATE acciones SET vence = ? WHERE id = ?", (vence, datos["id"]))
+        self._meter(datos)
+        return True
+
+    def _cima(self):
+        # Primera entrada viva del montículo, descartando canceladas y reprogramadas
+        while self._monticulo:
+            vence, id_accion = self._monticulo[0]
+            datos = self.acciones.get(id_accion)
+            if datos is not None and datos["vence"] == vence:
+                return vence
+            heapq.heappop(self._monticulo)
+        return None
+
+    def pendientes(self, chat_id):
+        return sorted((d for d in self.acciones.values() if d["chat_id"] == chat_id), key=lambda d: d["vence"])
+
+    async def ejecutar(self, app):
+        while True:
+            self._despertar.clear()
+            vence = self._cima()
+            espera = None if vence is None else vence - time.time()
+            if espera is None or espera > 0:
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Un fallo (SQLite, una acción mal guardada...) no puede parar la agenda entera
+            try:
+                # Todo lo que vence dentro de la ventana sale en el mismo lote y en una sola transacción
+                lote = []
+                limite = time.time() + AGENDA_VENTANA
+                with db() as conexion:
+                    while (vence := self._cima()) is not None and vence <= limite:
+                        _, id_accion = heapq.heappop(self._monticulo)
+                        datos = self.acciones.pop(id_accion)
+                        lote.append(datos)
+                        if not datos["repeticion"] or not self._reprogramar(conexion, datos, max(vence, time.time())):
+                            self._olvidar(conexion, id_accion)
+                await ejecutar_lote(app, lote)
+            except Exception as e:
+                logging.error(f"Error ejecutando acciones programadas: {e}")
+
+async def ejecutar_lote(app, lote):
+    # Las acciones de una misma habitación se fusionan en orden; las habitaciones
+    # de un bridge con el mismo cambio que cubren todas sus luces van al grupo 0.
+    # `lote` llega en el orden en que vencieron (las repetidas ya tienen su próximo vencimiento).
+    cambios = {}
+    for datos in lote:
+        if datos["habitacion"] in HABITACIONES:
+            fusionar_parches(cambios.setdefault(datos["habitacion"], {}), cambio_accion(datos))
+    por_cambio = {}
+    for habitacion, cambio in cambios.items():
+        clave = (HABITACIONES[habitacion].puente.nombre, json.dumps(cambio, sort_keys=True))
+        por_cambio.setdefault(clave, []).append(habitacion)
+    escrituras = []
+    for (nombre_puente, clave), habitaciones_lote in por_cambio.items():
+        puente = PUENTES[nombre_puente]
+        cambio = json.loads(clave)
+        cubiertas = {str(luz_id) for h in habitaciones_lote for luz_id in HABITACIONES[h].luces}
+        if len(habitaciones_lote) > 1 and puente.capacidades and set(puente.capacidades) <= cubiertas:
+            escrituras.append(puente.programador.enviar(puente.url("groups/0/action"), cambio))
+        else:
+            escrituras.extend(enviar_a_habitacion(h, cambio) for h in habitaciones_lote)
+        estado = {k: v for k, v in cambio.items() if k != "transitiontime"}
+        parches = {}
+        for h in habitaciones_lote:
+            parches.update(parches_habitacion(h, estado))
+        puente.cache.aplicar_optimista({luz_id: parche for (_, luz_id), parche in parches.items()})
+    logging.info(f"Agenda: {len(lote)} acciones en {len(escrituras)} escrituras")
+    await asyncio.gather(*escrituras)
+    # Los paneles se repintan aparte para que un RetryAfter no retrase las siguientes acciones
+    programar_refresco(app, set(cambios))
+
+AGENDA = AgendaAcciones()
+
+# ─────────────────────────────────────────────────────────────
+# Historial de consumo: totales por hora y por día
+# ─────────────────────────────────────────────────────────────
+
+# Cada muestra suma al intervalo anterior el estado visto en la muestra previa; los
+# totales de la hora en curso se acumulan en memoria y se vuelcan a SQLite al cambiar
+# de hora. Así el disco crece con habitaciones × horas, no con las muestras.
+HISTORIAL = {"hora": None, "ultima": None, "estados": {}, "acumulado": {}}
+
+def consumo_habitacion(snapshot, habitacion):
+    # (alguna luz encendida, vatios estimados) o None si el bridge no se pudo leer
+    luces = list(luces_en_snapshot(snapshot, habitacion))
+    if not luces:
+        return None
+    encendidas = [estado for _, estado in luces if estado["on"]]
+    vatios = sum(HUE_VATIOS_LUZ * estado.get("bri", 254) / 254 for estado in encendidas)
+    return bool(encendidas), vatios
 
-    new_markup_dict = new_markup.to_dict()
+def registrar_muestra(snapshot, ahora):
+    anterior = HISTORIAL["ultima"]
+    # Tras un corte largo (bot parado, bridge caído) no se inventa el estado intermedio
+    dt = 0 if anterior is None else min(ahora - anterior, 3 * HISTORIAL_INTERVALO)
+    hora = int(ahora // 3600 * 3600)
+    if HISTORIAL["hora"] is not None and HISTORIAL["hora"] != hora:
+        volcar_consumo()
+        purgar_consumo(ahora)
+    HISTORIAL["hora"] = hora
+    HISTORIAL["ultima"] = ahora
+    for habitacion in HABITACIONES:
+        previo = HISTORIAL["estados"].get(habitacion)
+        if previo is not None and dt > 0:
+            encendida, vatios = previo
+            acumulado = HISTORIAL["acumulado"].setdefault(habitacion, [0.0, 0.0])
+            acumulado[0] += dt if encendida else 0
+            acumulado[1] += vatios * dt / 3600
+        actual = consumo_habitacion(snapshot, habitacion)
+        if actual is not None:
+            HISTORIAL["estados"][habitacion] = actual
+        else:
+            # Sin lectura no se sabe si sigue encendida: el corte no se cobra
+            HISTORIAL["estados"].pop(habitacion, None)
 
-    if new_text == last_text and new_markup_dict == last_markup:
+def volcar_consumo():
+    # Suma lo acumulado a los totales de su hora y de su día (hora local)
+    hora = HISTORIAL["hora"]
+    if hora is None or not HISTORIAL["acumulado"]:
         return
+    dia = time.strftime("%Y-%m-%d", time.localtime(hora))
+    filas = [(h, segundos, wh) for h, (segundos, wh) in HISTORIAL["acumulado"].items()]
+    with db() as conexion:
+        conexion.executemany("""
+            INSERT INTO consumo_horas (habitacion, hora, segundos, wh) VALUES (?, ?, ?, ?)
+            ON CONFLICT (habitacion, hora) DO UPDATE SET
+                segundos = segundos + excluded.segundos, wh = wh + excluded.wh
+        """, [(h, hora, segundos, wh) for h, segundos, wh in filas])
+        conexion.executemany("""
+            INSERT INTO consumo_dias (habitacion, dia, segundos, wh) VALUES (?, ?, ?, ?)
+            ON CONFLICT (habitacion, dia) DO UPDATE SET
+                segundos = segundos + excluded.segundos, wh = wh + excluded.wh
+        """, [(h, dia, segundos, wh) for h, segundos, wh in filas])
+    HISTORIAL["acumulado"].clear()
 
-    try:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=new_text,
-            reply_markup=new_markup,
-            parse_mode="Markdown"
-        )
-        PANEL_LAST_STATE[chat_id] = {"text": new_text, "markup": new_markup_dict}
-    except Exception as e:
-        if "Message is not modified" in str(e):
-            return
-        logging.error(f"Error actualizando panel: {e}")
+def purgar_consumo(ahora):
+    with db() as conexion:
+        conexion.execute("DELETE FROM consumo_horas WHERE hora < ?", (ahora - HISTORIAL_DIAS_HORAS * 86400,))
+
+async def muestrear_consumo(context=None):
+    # Con la cache compartida (o el espejo del eventstream) muestrear casi nunca cuesta una lectura
+    snapshot = await obtener_snapshot_luces()
+    registrar_muestra(snapshot, time.time())
+
+def leer_periodo(texto):
+    # "24h", "7d", "30d"... -> (cantidad, unidad), o None si no es un periodo
+    coincidencia = re.fullmatch(r"(\d+)([hd])", texto.lower())
+    if not coincidencia or int(coincidencia.group(1)) == 0:
+        return None
+    return int(coincidencia.group(1)), coincidencia.group(2)
+
+def informe_consumo(cantidad, unidad, nombres):
+    # {habitación: (segundos encendida, Wh)} del periodo, desde los totales ya agregados:
+    # las últimas `cantidad` horas o los últimos `cantidad` días locales, hoy incluido.
+    volcar_consumo()
+    desde = time.time() - cantidad * (3600 if unidad == "h" else 86400)
+    marcas = ",".join("?" * len(nombres))
+    if unidad == "h":
+        filas = db().execute(
+            f"SELECT habitacion, SUM(segundos), SUM(wh) FROM consumo_horas "
+            f"WHERE hora >= ? AND habitacion IN ({marcas}) GROUP BY habitacion",
+            (int(desde // 3600 * 3600), *nombres)
+        ).fetchall()
+    else:
+        primer_dia = time.strftime("%Y-%m-%d", time.localtime(desde + 86400))
+        filas = db().execute(
+            f"SELECT habitacion, SUM(segundos), SUM(wh) FROM consumo_dias "
+            f"WHERE dia >= ? AND habitacion IN ({marcas}) GROUP BY habitacion",
+            (primer_dia, *nombres)
+        ).fetchall()
+    return {habitacion: (segundos_on, wh) for habitacion, segundos_on, wh in filas}
 
 # ─────────────────────────────────────────────────────────────
 # Función para eliminar el panel y cancelar sus jobs
@@ -232,9 +1918,7 @@ async def expirar_panel(context: CallbackContext, chat_id: int, message_id: int)
         await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
     except Exception as e:
         logging.error(f"Error eliminando mensaje: {e}")
-    update_job = PANEL_JOBS.pop(chat_id, None)
-    if update_job:
-        update_job.schedule_removal()
+    PANEL_MENSAJES.pop(chat_id, None)
     exp_job = EXPIRATION_JOBS.pop(chat_id, None)
     if exp_job:
         try:
@@ -243,6 +1927,8 @@ async def expirar_panel(context: CallbackContext, chat_id: int, message_id: int)
             logging.info(f"El job de expiración ya fue removido: {e}")
     PANEL_STATES.pop(chat_id, None)
     PANEL_LAST_STATE.pop(chat_id, None)
+    PANEL_USUARIOS.pop(chat_id, None)
+    borrar_panel(chat_id)
 
 def schedule_expiration(context: CallbackContext, chat_id: int, message_id: int, seconds: int = 60):
     exp_job = EXPIRATION_JOBS.get(chat_id)
@@ -253,11 +1939,22 @@ def schedule_expiration(context: CallbackContext, chat_id: int, message_id: int,
         when=seconds
     )
     EXPIRATION_JOBS[chat_id] = new_job
+    # Cada interacción reprograma la expiración; se guarda con el próximo lote
+    PANEL_EXPIRA[chat_id] = time.time() + seconds
+    marcar_panel(chat_id)
+
+def armar_jobs_panel(context, chat_id, message_id, seconds=60):
+    # `context` puede ser un CallbackContext o la propia Application: ambos tienen job_queue.
+    # El refresco lo hace refrescar_vistas para todos los paneles; aquí solo se registra
+    # el mensaje y se programa la expiración.
+    PANEL_MENSAJES[chat_id] = message_id
+    schedule_expiration(context, chat_id, message_id, seconds=seconds)
 
 # ─────────────────────────────────────────────────────────────
 # Handlers para comandos y callbacks
 # ─────────────────────────────────────────────────────────────
 
+@requiere_rol("readonly")
 async def hue(update: Update, context: CallbackContext) -> None:
     if update.effective_message is None:
         return
@@ -266,32 +1963,288 @@ async def hue(update: Update, context: CallbackContext) -> None:
     except Exception as e:
         logging.error(f"Error borrando comando: {e}")
 
-    texto, markup = await generar_panel_principal()
+    # El menú principal solo lista las habitaciones que puede ver quien lo abre
+    PANEL_USUARIOS[update.effective_chat.id] = update.effective_user.id
+    visibles = habitaciones_visibles(update.effective_user.id)
+    snapshot = await obtener_snapshot_luces(habitaciones_de_pagina(0, visibles))
+    filas = {}
+    texto, markup = await generar_panel_principal(snapshot, filas, habitaciones=visibles)
     message = await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=texto,
         reply_markup=markup,
         parse_mode="Markdown"
     )
-    PANEL_STATES[update.effective_chat.id] = "main"
-    context.chat_data["control_message"] = message.message_id
-
-    job_context = {"chat_id": update.effective_chat.id, "message_id": message.message_id}
-    update_job = context.job_queue.run_repeating(
-        actualizar_panel_periodicamente,
-        interval=10,
-        first=10,
-        data=job_context
+    PANEL_STATES[update.effective_chat.id] = "main:0"
+    PANEL_LAST_STATE[update.effective_chat.id] = {
+        "panel": "main:0",
+        "huellas": {h: huella_habitacion(snapshot, h) for h in habitaciones_de_pagina(0, visibles)},
+        "filas": filas
+    }
+
+    armar_jobs_panel(context, update.effective_chat.id, message.message_id, seconds=60)
+
+@requiere_rol("admin")
+async def stats(update: Update, context: CallbackContext) -> None:
+    if update.effective_message is None:
+        return
+    lineas = [
+        "📊 **Estadísticas del bot**",
+        f"Paneles abiertos: {len(PANEL_STATES)}",
+        f"Vistas distintas: {len({vista_de_chat(c) for c in PANEL_STATES})}",
+        f"Jobs programados: {len(context.application.job_queue.jobs())}",
+        f"Acciones en la agenda: {len(AGENDA.acciones)}",
+        "",
+        "🌉 Bridge (peticiones, media):"
+    ]
+    for clave, (_, suma, total) in sorted(BRIDGE_LATENCIA.series.items()):
+        etiquetas = dict(clave)
+        lineas.append(f"  {etiquetas['metodo']} {etiquetas['endpoint']}: {total}, {suma / total * 1000:.0f} ms")
+    errores = sum(BRIDGE_ERRORES.valores.values())
+    lineas.append(f"  Errores: {errores}")
+    lineas.append("🖼 Render de paneles (media):")
+    for clave, (_, suma, total) in sorted(PANEL_RENDER.series.items()):
+        lineas.append(f"  {dict(clave)['panel']}: {total}, {suma / total * 1000:.1f} ms")
+    for _, suma, total in TELEGRAM_EDICION.series.values():
+        lineas.append(f"✏️ Ediciones en Telegram: {total}, {suma / total * 1000:.0f} ms de media")
+    lineas.append(f"Sin cambios (\"not modified\"): {sum(TELEGRAM_NO_MODIFICADO.valores.values())}")
+    lineas.append(f"Refrescos omitidos por huella: {sum(PANEL_OMITIDO.valores.values())}")
+    lineas.append(f"RetryAfter recibidos: {sum(TELEGRAM_RETRY_AFTER.valores.values())}")
+    await update.effective_message.reply_text("\n".join(lineas), parse_mode="Markdown")
+
+def habitacion_del_panel(chat_id):
+    panel = PANEL_STATES.get(chat_id, "")
+    if panel.startswith("room:") or panel.startswith("color:"):
+        habitacion = panel.split(":", 1)[1]
+        if habitacion in HABITACIONES:
+            return habitacion
+    return None
+
+@requiere_rol("member")
+async def escena(update: Update, context: CallbackContext) -> None:
+    # /scene save <nombre> | /scene delete <nombre> | /scene, sobre la habitación abierta en el panel
+    if update.effective_message is None:
+        return
+    chat_id = update.effective_chat.id
+    habitacion = habitacion_del_panel(chat_id)
+    args = list(context.args or [])
+    accion = args.pop(0).lower() if args else ""
+    nombre = " ".join(args).strip()[:ESCENAS_MAX_NOMBRE]
+    if habitacion is None:
+        await update.effective_message.reply_text("Abre una habitación con /hue y usa /scene save <nombre>")
+        return
+    if not permiso(update.effective_user.id, habitacion):
+        await update.effective_message.reply_text(f"🔒 Solo lectura en {habitacion}")
+        return
+    if accion == "save" and nombre:
+        snapshot = await obtener_snapshot_luces([habitacion])
+        if await guardar_escena(habitacion, nombre, snapshot) is None:
+            await update.effective_message.reply_text(f"No se pudo leer el estado de {habitacion}")
+            return
+        respuesta = f"🎬 Escena «{nombre}» guardada en {habitacion}"
+    elif accion == "delete" and nombre:
+        if not await borrar_escena(habitacion, nombre):
+            await update.effective_message.reply_text(f"No hay ninguna escena «{nombre}» en {habitacion}")
+            return
+        respuesta = f"🗑 Escena «{nombre}» borrada de {habitacion}"
+    else:
+        nombres = ", ".join(ESCENAS.get(habitacion, {})) or "ninguna"
+        await update.effective_message.reply_text(
+            f"Escenas de {habitacion}: {nombres}\nUso: /scene save <nombre> | /scene delete <nombre>"
+        )
+        return
+    await update.effective_message.reply_text(respuesta)
+    # El panel abierto gana o pierde el botón de la escena
+    message_id = PANEL_MENSAJES.get(chat_id)
+    if message_id and PANEL_STATES.get(chat_id) == f"room:{habitacion}":
+        await mostrar_panel(context, chat_id, message_id, f"room:{habitacion}",
+                            await obtener_snapshot_luces([habitacion]))
+
+@requiere_rol("member")
+async def rampa(update: Update, context: CallbackContext) -> None:
+    # /ramp <porcentaje> [minutos]: fundido de la habitación abierta hasta ese brillo
+    if update.effective_message is None:
+        return
+    chat_id = update.effective_chat.id
+    habitacion = habitacion_del_panel(chat_id)
+    try:
+        porcentaje = int(context.args[0])
+        minutos = float(context.args[1]) if len(context.args) > 1 else 1
+        if not math.isfinite(minutos) or minutos < 0:
+            # float() acepta "inf" y "nan"
+            raise ValueError(minutos)
+    except (IndexError, ValueError, TypeError):
+        await update.effective_message.reply_text("Uso: /ramp <porcentaje> [minutos], con una habitación abierta en /hue")
+        return
+    if habitacion is None:
+        await update.effective_message.reply_text("Abre una habitación con /hue y usa /ramp <porcentaje> [minutos]")
+        return
+    if not permiso(update.effective_user.id, habitacion):
+        await update.effective_message.reply_text(f"🔒 Solo lectura en {habitacion}")
+        return
+    parches, escrituras = rampa_habitacion(habitacion, porcentaje, minutos * 60)
+    message_id = PANEL_MENSAJES.get(chat_id)
+    await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras, f"room:{habitacion}",
+                            f"🌅 **{escape_markdown(habitacion)} al {max(porcentaje, 0)}% en {minutos:g} min**")
+    schedule_expiration(context, chat_id, message_id, seconds=60)
+
+def buscar_habitacion(texto):
+    for habitacion in HABITACIONES:
+        if habitacion.lower() == texto.strip().lower():
+            return habitacion
+    return None
+
+def segundos_de_duracion(texto):
+    # "30m", "2h", "1h30m", "45s" o minutos a secas
+    if texto.isdigit():
+        return int(texto) * 60
+    partes = re.findall(r"(\d+)([hms])", texto.lower())
+    if not partes or "".join(n + u for n, u in partes) != texto.lower():
+        return None
+    return sum(int(n) * {"h": 3600, "m": 60, "s": 1}[u] for n, u in partes)
+
+@requiere_rol("member")
+async def temporizador(update: Update, context: CallbackContext) -> None:
+    # /timer <habitación> <on|off> <duración>
+    if update.effective_message is None:
+        return
+    args = list(context.args or [])
+    segundos = segundos_de_duracion(args[-1]) if len(args) >= 3 else None
+    habitacion = buscar_habitacion(" ".join(args[:-2])) if len(args) >= 3 else None
+    if segundos is None or habitacion is None or args[-2].lower() not in ("on", "off"):
+        await update.effective_message.reply_text("Uso: /timer <habitación> <on|off> <duración, p. ej. 30m o 1h30m>")
+        return
+    if not permiso(update.effective_user.id, habitacion):
+        await update.effective_message.reply_text(f"🔒 Solo lectura en {habitacion}")
+        return
+    datos = AGENDA.programar(update.effective_chat.id, habitacion, args[-2].lower(), time.time() + segundos)
+    await update.effective_message.reply_text(
+        f"⏲ {habitacion} {'se encenderá' if datos['accion'] == 'on' else 'se apagará'} a las "
+        f"{time.strftime('%H:%M', time.localtime(datos['vence']))} (#{datos['id']})"
     )
-    PANEL_JOBS[update.effective_chat.id] = update_job
 
-    schedule_expiration(context, update.effective_chat.id, message.message_id, seconds=60)
+@requiere_rol("member")
+async def horario(update: Update, context: CallbackContext) -> None:
+    # /schedule <habitación> <on|off> <HH:MM|sunset|sunrise>[±minutos], todos los días
+    if update.effective_message is None:
+        return
+    args = list(context.args or [])
+    habitacion = buscar_habitacion(" ".join(args[:-2])) if len(args) >= 3 else None
+    repeticion = args[-1].lower() if args else ""
+    if (habitacion is None or args[-2].lower() not in ("on", "off")
+            or not re.fullmatch(rf"(sunrise|sunset|{HORA_VALIDA})([+-]\d+)?", repeticion)):
+        await update.effective_message.reply_text("Uso: /schedule <habitación> <on|off> <HH:MM|sunset|sunrise>[+-minutos]")
+        return
+    if not permiso(update.effective_user.id, habitacion):
+        await update.effective_message.reply_text(f"🔒 Solo lectura en {habitacion}")
+        return
+    vence = siguiente_vencimiento(repeticion, time.time())
+    if vence is None:
+        await update.effective_message.reply_text("En esta ubicación el sol no sale o no se pone estos días")
+        return
+    datos = AGENDA.programar(update.effective_chat.id, habitacion, args[-2].lower(), vence, repeticion=repeticion)
+    await update.effective_message.reply_text(
+        f"📅 {habitacion} {args[-2].lower()} cada día a las {repeticion} "
+        f"(próxima: {time.strftime('%d/%m %H:%M', time.localtime(vence))}, #{datos['id']})"
+    )
+
+@requiere_rol("member")
+async def despertador(update: Update, context: CallbackContext) -> None:
+    # /wake <habitación> <HH:MM> [minutos]: cada día sube la luz para llegar al 100 % a esa hora
+    if update.effective_message is None:
+        return
+    args = list(context.args or [])
+    minutos = 15
+    if len(args) >= 3 and args[-1].isdigit() and ":" in args[-2]:
+        minutos = min(int(args.pop()), 109)
+    hora = args[-1] if args else ""
+    habitacion = buscar_habitacion(" ".join(args[:-1])) if len(args) >= 2 else None
+    if habitacion is None or not re.fullmatch(HORA_VALIDA, hora):
+        await update.effective_message.reply_text("Uso: /wake <habitación> <HH:MM> [minutos de fundido]")
+        return
+    if not permiso(update.effective_user.id, habitacion):
+        await update.effective_message.reply_text(f"🔒 Solo lectura en {habitacion}")
+        return
+    # Empieza `minutos` antes para que el fundido termine a la hora pedida
+    repeticion = f"{hora}-{minutos}"
+    vence = siguiente_vencimiento(repeticion, time.time())
+    datos = AGENDA.programar(update.effective_chat.id, habitacion, "wake", vence, parametro=minutos, repeticion=repeticion)
+    await update.effective_message.reply_text(
+        f"🌅 {habitacion} se irá encendiendo {minutos} min hasta las {hora} cada día (#{datos['id']})"
+    )
+
+@requiere_rol("readonly")
+async def informe(update: Update, context: CallbackContext) -> None:
+    # /report [habitación] [periodo]: horas encendida y kWh estimados (por defecto, 7 días)
+    if update.effective_message is None:
+        return
+    args = list(context.args or [])
+    periodo = leer_periodo(args[-1]) if args else None
+    if periodo is not None:
+        args.pop()
+    else:
+        periodo = (7, "d")
+    nombres = list(habitaciones_visibles(update.effective_user.id))
+    if args:
+        habitacion = buscar_habitacion(" ".join(args))
+        if habitacion not in nombres:
+            await update.effective_message.reply_text("Uso: /report [habitación] [periodo, p. ej. 24h, 7d o 30d]")
+            return
+        nombres = [habitacion]
+    datos = informe_consumo(*periodo, nombres)
+    cantidad, unidad = periodo
+    texto_periodo = f"{cantidad} h" if unidad == "h" else ("hoy" if cantidad == 1 else f"{cantidad} días")
+    lineas = [f"📈 **Consumo ({texto_periodo})**"]
+    for habitacion in sorted(nombres, key=lambda h: -datos.get(h, (0, 0))[1]):
+        segundos_on, wh = datos.get(habitacion, (0, 0))
+        lineas.append(f"{escape_markdown(habitacion)}: {segundos_on / 3600:.1f} h encendida, {wh / 1000:.2f} kWh")
+    if len(nombres) > 1:
+        lineas.append(f"Total: {sum(wh for _, wh in datos.values()) / 1000:.2f} kWh")
+    await update.effective_message.reply_text("\n".join(lineas), parse_mode="Markdown")
+
+@requiere_rol("member")
+async def temporizadores(update: Update, context: CallbackContext) -> None:
+    # /timers lista las acciones del chat; /timers cancel <id> borra una
+    if update.effective_message is None:
+        return
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    # En un chat compartido cada uno solo ve y cancela las acciones de sus habitaciones
+    visibles = set(habitaciones_visibles(user_id))
+    args = list(context.args or [])
+    if len(args) == 2 and args[0].lower() == "cancel":
+        id_accion = int(args[1].lstrip("#")) if args[1].lstrip("#").isdigit() else None
+        datos = AGENDA.acciones.get(id_accion)
+        if datos is None or datos["chat_id"] != chat_id or datos["habitacion"] not in visibles:
+            await update.effective_message.reply_text("No existe esa acción")
+            return
+        if not permiso(user_id, datos["habitacion"]):
+            await update.effective_message.reply_text(f"🔒 Solo lectura en {datos['habitacion']}")
+            return
+        cancelada = AGENDA.cancelar(id_accion, chat_id)
+        await update.effective_message.reply_text("🗑 Acción cancelada" if cancelada else "No existe esa acción")
+        return
+    lineas = ["⏰ **Acciones programadas**"]
+    for datos in AGENDA.pendientes(chat_id):
+        if datos["habitacion"] not in visibles:
+            continue
+        cuando = time.strftime("%d/%m %H:%M", time.localtime(datos["vence"]))
+        repite = f", cada día ({datos['repeticion']})" if datos["repeticion"] else ""
+        lineas.append(f"#{datos['id']} {escape_markdown(datos['habitacion'])} {escape_markdown(datos['accion'])}: "
+                      f"{cuando}{repite}")
+    if len(lineas) == 1:
+        lineas.append("Ninguna")
+    await update.effective_message.reply_text("\n".join(lineas), parse_mode="Markdown")
 
 async def callback_handler(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    await query.answer()
+    # En un chat compartido cada botón se autoriza según quién lo pulsa
+    denegado = motivo_denegacion(query.from_user.id, query.data)
+    await query.answer(denegado)
+    if denegado:
+        return
     chat_id = query.message.chat_id
-    message_id = context.chat_data.get("control_message")
+    message_id = PANEL_MENSAJES.get(chat_id)
     data = query.data
 
     # Cada vez que el usuario interactúa (excepto al cerrar) se reprograma la expiración
@@ -304,94 +2257,93 @@ async def callback_handler(update: Update, context: CallbackContext) -> None:
         await expirar_panel(context, chat_id, message_id)
         return
 
+    # Tras cambiar la configuración pueden quedar botones de habitaciones que ya no existen
+    if ":" in data and not data.startswith("page:") and data.rsplit(":", 1)[-1] not in HABITACIONES:
+        logging.info(f"Botón de una habitación desconocida: {data}")
+        return
+
     if data == "volver":
-        PANEL_STATES[chat_id] = "main"
-        texto, markup = await generar_panel_principal()
-        await actualizar_mensaje(context, chat_id, message_id, texto, markup)
+        await navegar(context, chat_id, message_id, f"main:{pagina_de_chat(chat_id)}")
+        reprogramar()
+        return
+
+    if data.startswith("page:"):
+        try:
+            pagina = min(max(int(data.split("page:")[1]), 0), total_paginas(habitaciones_de_chat(chat_id)) - 1)
+        except ValueError:
+            return
+        await navegar(context, chat_id, message_id, f"main:{pagina}")
         reprogramar()
         return
 
     if data.startswith("backroom:"):
         habitacion = data.split("backroom:")[1]
-        PANEL_STATES[chat_id] = f"room:{habitacion}"
-        texto, markup = await generar_panel_habitacion(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, texto, markup)
+        await navegar(context, chat_id, message_id, f"room:{habitacion}")
         reprogramar()
         return
 
     if data == "apagar_todo":
-        for luces in habitaciones.values():
-            for luz_id in luces:
-                url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state"
-                safe_put(url, {"on": False})
-        PANEL_STATES[chat_id] = "main"
-        texto, markup = await generar_panel_principal()
-        await actualizar_mensaje(context, chat_id, message_id, "🛑 **Todas las luces han sido apagadas**", markup)
+        escrituras = [enviar_a_todas({"on": False})]
+        parches = {}
+        for habitacion in HABITACIONES:
+            parches.update(parches_habitacion(habitacion, {"on": False}))
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"main:{pagina_de_chat(chat_id)}",
+                                "🛑 **Todas las luces han sido apagadas**")
         reprogramar()
         return
 
     if data.startswith("room:"):
         habitacion = data.split("room:")[1]
-        PANEL_STATES[chat_id] = f"room:{habitacion}"
-        texto, markup = await generar_panel_habitacion(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, texto, markup)
+        await navegar(context, chat_id, message_id, f"room:{habitacion}")
         reprogramar()
         return
 
     if data.startswith("toggle:"):
         habitacion = data.split("toggle:")[1]
-        estados = []
-        for luz_id in habitaciones[habitacion]:
-            url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-            resp = safe_get(url)
-            if resp is not None:
-                estados.append(resp["state"]["on"])
-        nuevo_estado = not any(estados)
-        for luz_id in habitaciones[habitacion]:
-            url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state"
-            safe_put(url, {"on": nuevo_estado})
+        snapshot = await obtener_snapshot_luces([habitacion])
+        nuevo_estado = not any(estado["on"] for _, estado in luces_en_snapshot(snapshot, habitacion))
+        escrituras = [enviar_a_habitacion(habitacion, {"on": nuevo_estado})]
+        parches = parches_habitacion(habitacion, {"on": nuevo_estado})
         estado_texto = "encendidas" if nuevo_estado else "apagadas"
-        texto, markup = await generar_panel_habitacion(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, f"✅ **Luces en {habitacion} {estado_texto}**", markup)
-        PANEL_STATES[chat_id] = f"room:{habitacion}"
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"room:{habitacion}", f"✅ **Luces en {escape_markdown(habitacion)} {estado_texto}**")
+        reprogramar()
+        return
+
+    if data.startswith("escena:"):
+        _, id_local, habitacion = data.split(":", 2)
+        try:
+            nombre, escena_guardada = escena_por_id(habitacion, int(id_local))
+        except ValueError:
+            return
+        if escena_guardada is None:
+            logging.info(f"Escena desconocida: {data}")
+            return
+        parches, escrituras = recuperar_escena(habitacion, escena_guardada)
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"room:{habitacion}", f"🎬 **Escena {escape_markdown(nombre)} aplicada en {escape_markdown(habitacion)}**")
         reprogramar()
         return
 
     if data.startswith("bright_inc:"):
         habitacion = data.split("bright_inc:")[1]
-        step = 25
-        for luz_id in habitaciones[habitacion]:
-            url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-            response = safe_get(url)
-            if response:
-                current_bri = response["state"].get("bri", 0) if response["state"]["on"] else 0
-                current_pct = int(current_bri * 100 / 254)
-                nuevo_pct = min(current_pct + step, 100)
-                nuevo_bri = int(nuevo_pct * 254 / 100)
-                safe_put(f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state",
-                         {"on": True, "bri": nuevo_bri})
-        PANEL_STATES[chat_id] = f"room:{habitacion}"
-        texto, markup = await generar_panel_habitacion(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, f"🔆 **Brillo aumentado en {habitacion}**", markup)
+        step = PASO_BRILLO
+        # El bridge suma el paso con un fundido: no hace falta leer antes de escribir
+        escrituras = [enviar_a_habitacion(habitacion, {"on": True, "bri_inc": step, "transitiontime": HUE_TRANSICION_PASO})]
+        parches = parches_incremento(await obtener_snapshot_luces([habitacion]), habitacion, "bri", step)
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"room:{habitacion}", f"🔆 **Brillo aumentado en {escape_markdown(habitacion)}**")
         reprogramar()
         return
 
     if data.startswith("bright_dec:"):
         habitacion = data.split("bright_dec:")[1]
-        step = 25
-        for luz_id in habitaciones[habitacion]:
-            url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-            response = safe_get(url)
-            if response:
-                current_bri = response["state"].get("bri", 0) if response["state"]["on"] else 0
-                current_pct = int(current_bri * 100 / 254)
-                nuevo_pct = max(current_pct - step, 0)
-                nuevo_bri = int(nuevo_pct * 254 / 100) if nuevo_pct > 0 else 1
-                safe_put(f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state",
-                         {"on": True, "bri": nuevo_bri})
-        PANEL_STATES[chat_id] = f"room:{habitacion}"
-        texto, markup = await generar_panel_habitacion(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, f"🔅 **Brillo disminuido en {habitacion}**", markup)
+        step = PASO_BRILLO
+        escrituras = [enviar_a_habitacion(habitacion, {"on": True, "bri_inc": -step, "transitiontime": HUE_TRANSICION_PASO})]
+        parches = parches_incremento(await obtener_snapshot_luces([habitacion]), habitacion, "bri", -step)
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"room:{habitacion}", f"🔅 **Brillo disminuido en {escape_markdown(habitacion)}**")
         reprogramar()
         return
 
@@ -402,12 +2354,10 @@ async def callback_handler(update: Update, context: CallbackContext) -> None:
                 valor_pct = int(parts[1])
                 habitacion = parts[2]
                 nuevo_bri = int(valor_pct * 254 / 100)
-                for luz_id in habitaciones[habitacion]:
-                    safe_put(f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state",
-                             {"on": True, "bri": nuevo_bri})
-                PANEL_STATES[chat_id] = f"room:{habitacion}"
-                texto, markup = await generar_panel_habitacion(habitacion)
-                await actualizar_mensaje(context, chat_id, message_id, f"🔆 **Brillo ajustado al {valor_pct}% en {habitacion}**", markup)
+                escrituras = [enviar_a_habitacion(habitacion, {"on": True, "bri": nuevo_bri})]
+                parches = parches_habitacion(habitacion, {"on": True, "bri": nuevo_bri})
+                await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                        f"room:{habitacion}", f"🔆 **Brillo ajustado al {valor_pct}% en {escape_markdown(habitacion)}**")
                 reprogramar()
             except ValueError:
                 logging.error("Valor de brillo inválido")
@@ -415,9 +2365,7 @@ async def callback_handler(update: Update, context: CallbackContext) -> None:
 
     if data.startswith("color:"):
         habitacion = data.split("color:")[1]
-        PANEL_STATES[chat_id] = f"color:{habitacion}"
-        texto, markup = await generar_panel_color(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, texto, markup)
+        await navegar(context, chat_id, message_id, f"color:{habitacion}")
         reprogramar()
         return
 
@@ -428,12 +2376,10 @@ async def callback_handler(update: Update, context: CallbackContext) -> None:
                 hue_val = int(parts[1])
                 sat_val = int(parts[2])
                 habitacion = parts[3]
-                for luz_id in habitaciones[habitacion]:
-                    safe_put(f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state",
-                             {"on": True, "hue": hue_val, "sat": sat_val})
-                PANEL_STATES[chat_id] = f"room:{habitacion}"
-                texto, markup = await generar_panel_habitacion(habitacion)
-                await actualizar_mensaje(context, chat_id, message_id, f"🎨 **Tono de color aplicado en {habitacion}**", markup)
+                escrituras = [enviar_a_habitacion(habitacion, {"on": True, "hue": hue_val, "sat": sat_val})]
+                parches = parches_habitacion(habitacion, {"on": True, "hue": hue_val, "sat": sat_val})
+                await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                        f"room:{habitacion}", f"🎨 **Tono de color aplicado en {escape_markdown(habitacion)}**")
                 reprogramar()
             except ValueError:
                 logging.error("Valor de color inválido")
@@ -441,41 +2387,77 @@ async def callback_handler(update: Update, context: CallbackContext) -> None:
 
     if data.startswith("ct_inc:"):
         habitacion = data.split("ct_inc:")[1]
-        step_ct = 20
-        for luz_id in habitaciones[habitacion]:
-            url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-            response = safe_get(url)
-            if response and "ct" in response["state"]:
-                current_ct = response["state"]["ct"]
-                new_ct = min(current_ct + step_ct, 500)
-                safe_put(f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state",
-                         {"on": True, "ct": new_ct})
-        PANEL_STATES[chat_id] = f"color:{habitacion}"
-        texto, markup = await generar_panel_color(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, f"🎨 **Tono ajustado en {habitacion} (más amarillo)**", markup)
+        step_ct = PASO_CT
+        # Solo se encienden las luces con ct; el bridge recorta el ct_inc al rango de cada una
+        escrituras = [enviar_a_luces_con(habitacion, "ct", {"on": True, "ct_inc": step_ct, "transitiontime": HUE_TRANSICION_PASO})]
+        parches = parches_incremento(await obtener_snapshot_luces([habitacion]), habitacion, "ct", step_ct)
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"color:{habitacion}", f"🎨 **Tono ajustado en {escape_markdown(habitacion)} (más amarillo)**")
         reprogramar()
         return
 
     if data.startswith("ct_dec:"):
         habitacion = data.split("ct_dec:")[1]
-        step_ct = 20
-        for luz_id in habitaciones[habitacion]:
-            url = f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}"
-            response = safe_get(url)
-            if response and "ct" in response["state"]:
-                current_ct = response["state"]["ct"]
-                new_ct = max(current_ct - step_ct, 153)
-                safe_put(f"http://{HUE_BRIDGE_IP}/api/{HUE_USERNAME}/lights/{luz_id}/state",
-                         {"on": True, "ct": new_ct})
-        PANEL_STATES[chat_id] = f"color:{habitacion}"
-        texto, markup = await generar_panel_color(habitacion)
-        await actualizar_mensaje(context, chat_id, message_id, f"🎨 **Tono ajustado en {habitacion} (más blanco)**", markup)
+        step_ct = PASO_CT
+        escrituras = [enviar_a_luces_con(habitacion, "ct", {"on": True, "ct_inc": -step_ct, "transitiontime": HUE_TRANSICION_PASO})]
+        parches = parches_incremento(await obtener_snapshot_luces([habitacion]), habitacion, "ct", -step_ct)
+        await aplicar_y_mostrar(context, chat_id, message_id, parches, escrituras,
+                                f"color:{habitacion}", f"🎨 **Tono ajustado en {escape_markdown(habitacion)} (más blanco)**")
         reprogramar()
         return
 
+SERVIDOR_METRICAS = None
+APLICACION = None  # Para las métricas, que no reciben contexto
+
+async def iniciar_bot(app):
+    global SERVIDOR_METRICAS, APLICACION
+    APLICACION = app
+    await asyncio.gather(preparar_grupos(app), actualizar_todas_capacidades())
+    app.job_queue.run_repeating(muestrear_consumo, interval=HISTORIAL_INTERVALO, first=HISTORIAL_INTERVALO)
+    app.job_queue.run_repeating(refrescar_vistas, interval=PANEL_INTERVALO_REFRESCO, first=PANEL_INTERVALO_REFRESCO)
+    app.job_queue.run_repeating(actualizar_todas_capacidades, interval=HUE_INTERVALO_CAPACIDADES,
+                                first=HUE_INTERVALO_CAPACIDADES)
+    cargar_escenas()
+    AGENDA.cargar()
+    AGENDA.tarea = asyncio.create_task(AGENDA.ejecutar(app))
+    await restaurar_paneles(app)
+    if METRICAS_PUERTO:
+        SERVIDOR_METRICAS = await asyncio.start_server(servir_metricas, METRICAS_HOST, METRICAS_PUERTO)
+    for puente in PUENTES.values():
+        if puente.eventstream:
+            puente.tarea_eventstream = asyncio.create_task(escuchar_eventstream(app, puente))
+
+async def detener_bot(app):
+    volcar_consumo()
+    guardar_paneles()
+    if AGENDA.tarea:
+        AGENDA.tarea.cancel()
+    for puente in PUENTES.values():
+        if puente.tarea_eventstream:
+            puente.tarea_eventstream.cancel()
+    if SERVIDOR_METRICAS:
+        SERVIDOR_METRICAS.close()
+    await cerrar_cliente_hue(app)
+
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    cargar_configuracion()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(iniciar_bot)
+        .post_shutdown(detener_bot)
+        .concurrent_updates(True)
+        .build()
+    )
     app.add_handler(CommandHandler("hue", hue, filters=filters.ALL))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("scene", escena))
+    app.add_handler(CommandHandler("ramp", rampa))
+    app.add_handler(CommandHandler("timer", temporizador))
+    app.add_handler(CommandHandler("schedule", horario))
+    app.add_handler(CommandHandler("wake", despertador))
+    app.add_handler(CommandHandler("timers", temporizadores))
+    app.add_handler(CommandHandler("report", informe))
     app.add_handler(CallbackQueryHandler(callback_handler))
     app.run_polling(drop_pending_updates=True)
 